@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+
+import argparse
+import numpy as np
+import sys
+import time
+import torch
+
+from Input import Data, f1_matrix, f1_score
+from Main import get_batch
+from qNet import qNet
+
+def init_parser():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--benchmark', default='f1_matrix',
+                      help = "Benchmark to run. One of 'f1_matrix', 'get_batch' or "\
+                             "'match_layer'.")
+  parser.add_argument('--train_pickle',
+                      help = "Path to the train data arrays directory to read examples from.")
+  parser.add_argument('--batch_size', type=int, default=32,
+                      help = "Batch size to use for batch construction benchmarks.")
+  parser.add_argument('--max_examples', type=int, default=-1,
+                      help = "Maximum number of examples to benchmark over. -1 uses all of them.")
+  parser.add_argument('--hidden_size', type=int, default=300,
+                      help = "Hidden size of the benchmarked model layers.")
+  parser.add_argument('--attention_size', type=int, default=150,
+                      help = "Attention size of the benchmarked model layers.")
+  parser.add_argument('--passage_len', type=int, default=150,
+                      help = "Maximum passage length of the benchmarked batches.")
+  parser.add_argument('--question_len', type=int, default=15,
+                      help = "Maximum question length of the benchmarked batches.")
+  parser.add_argument('--num_runs', type=int, default=5,
+                      help = "Number of times to run model layer benchmarks.")
+  parser.add_argument('--cuda', action='store_true',
+                      help = "Benchmark model layers on the GPU.")
+  parser.add_argument('--selfmatch_window', type=int, default=16,
+                      help = "Window of the benchmarked windowed self-matching layer.")
+  parser.add_argument('--selfmatch_global', type=int, default=4,
+                      help = "Number of passage summaries of the benchmarked windowed "\
+                             "self-matching layer.")
+  return parser
+
+# Time a function call, returning its result and the time taken.
+def timed(fn, *args):
+  start_t = time.time()
+  result = fn(*args)
+  return result, time.time() - start_t
+
+
+#------------------------------ F1 target matrices ----------------------------#
+# Reference implementation of the F1 matrix, with a Python loop over each cell.
+def f1_matrix_loop(ans_start_idx, ans_end_idx, para_len):
+  f1_partial_matrix = np.zeros((ans_end_idx+1, para_len-ans_start_idx))
+  for start in range(0, ans_end_idx+1):
+    for end in range(max(start, ans_start_idx), para_len):
+      f1_partial_matrix[start, end-ans_start_idx] = \
+        f1_score(start, end, ans_start_idx, ans_end_idx)
+  return f1_partial_matrix
+
+def benchmark_f1_matrix(args, data):
+  spans = [ (example[1][0], example[1][1],
+             len(data.tokenized_paras[data.question_to_paragraph[example[2]]])) \
+              for example in data.data ]
+  print "Computing F1 matrices for %d answers." % len(spans)
+  loop_matrices, loop_t = \
+    timed(lambda: [ f1_matrix_loop(*span) for span in spans ])
+  print "Python loop: %.2fs" % loop_t
+  vectorized_matrices, vectorized_t = \
+    timed(lambda: [ f1_matrix(*span) for span in spans ])
+  print "Vectorized: %.2fs" % vectorized_t
+  for loop_matrix, vectorized_matrix in zip(loop_matrices, vectorized_matrices):
+    assert np.array_equal(loop_matrix, vectorized_matrix)
+  print "Matrices are identical. Speedup: %.1fx" % (loop_t / vectorized_t)
+#------------------------------------------------------------------------------#
+
+
+
+#------------------------------ Batch construction ----------------------------#
+def pad(seq, element, length):
+  return list(seq) + [element] * (length - len(seq))
+
+def one_hot(pos, size):
+  return [ 1 if i == pos else 0 for i in range(size) ]
+
+# Reference implementation of padded token and one-hot tag inputs of a batch,
+# built with Python lists.
+def get_batch_inputs_lists(batch, ques_to_para, tokenized_paras, paras_pos_tags,
+                           paras_ner_tags, question_pos_tags, question_ner_tags,
+                           num_pos_tags, num_ner_tags):
+  paras_in = [ tokenized_paras[ques_to_para[example[2]]] for example in batch ]
+  max_ques_len = max([ len(example[0]) for example in batch ])
+  max_para_len = max([ len(para) for para in paras_in ])
+  ques_in = np.array([ pad(example[0], 0, max_ques_len) for example in batch ]).T
+  paras_in = np.array([ pad(para, 0, max_para_len) for para in paras_in ]).T
+  tags = []
+  for tags_in, num_tags, max_len in \
+        [ ([ question_pos_tags[example[2]] for example in batch ],
+           num_pos_tags, max_ques_len),
+          ([ question_ner_tags[example[2]] for example in batch ],
+           num_ner_tags, max_ques_len),
+          ([ paras_pos_tags[ques_to_para[example[2]]] for example in batch ],
+           num_pos_tags, max_para_len),
+          ([ paras_ner_tags[ques_to_para[example[2]]] for example in batch ],
+           num_ner_tags, max_para_len) ]:
+    tags.append(np.transpose(
+      np.array([ pad([ one_hot(tag, num_tags) for tag in seq_tags ],
+                     one_hot(-1, num_tags), max_len) for seq_tags in tags_in ]),
+      (1, 0, 2)))
+  return [ ques_in, paras_in ] + tags
+
+def benchmark_get_batch(args, data):
+  num_pos_tags = len(data.dictionary.pos_tags)
+  num_ner_tags = len(data.dictionary.ner_tags)
+  batches = [ data.data[i:i+args.batch_size] \
+                for i in range(0, len(data.data), args.batch_size) ]
+  inputs = (data.question_to_paragraph, data.tokenized_paras,
+            data.paras_pos_tags, data.paras_ner_tags, data.question_pos_tags,
+            data.question_ner_tags, num_pos_tags, num_ner_tags)
+  print "Building %d batches of size %d." % (len(batches), args.batch_size)
+  list_batches, list_t = \
+    timed(lambda: [ get_batch_inputs_lists(batch, *inputs) for batch in batches ])
+  print "Python lists: %.2fs (%.2f ms/batch)" % \
+        (list_t, 1000 * list_t / len(batches))
+  numpy_batches, numpy_t = \
+    timed(lambda: [ get_batch(batch, *(inputs + (False,))) for batch in batches ])
+  print "Preallocated numpy: %.2fs (%.2f ms/batch)" % \
+        (numpy_t, 1000 * numpy_t / len(batches))
+  for list_batch, numpy_batch in zip(list_batches, numpy_batches):
+    ques_in, paras_in, q_pos, q_ner, p_pos, p_ner = list_batch
+    assert np.array_equal(ques_in, numpy_batch[1][0])
+    assert np.array_equal(paras_in, numpy_batch[0][0])
+    for expected, tags in zip([ q_pos, q_ner, p_pos, p_ner ], numpy_batch[4:8]):
+      assert np.array_equal(expected, tags)
+  print "Batches are identical. Speedup: %.1fx" % (list_t / numpy_t)
+#------------------------------------------------------------------------------#
+
+
+
+#------------------------------ Match layers ----------------------------------#
+# Reference implementation of the question-passage MatchLSTM layer, running the
+# forward and backward directions separately, with a list of per-step
+# question+passage attention terms.
+def match_question_passage_loop(model, layer_no, Hpi, Hq, max_passage_len,
+                                passage_lens, batch_size, mask_p, mask_q):
+  hf, cf = model.get_initial_lstm(batch_size, model.hidden_size // 2)
+  hb, cb = model.get_initial_lstm(batch_size, model.hidden_size // 2)
+  attended_question = getattr(model, 'attend_question_for_passage_' + layer_no)(Hq)
+  attended_passage = getattr(model, 'attend_passage_for_passage_' + layer_no)(Hpi)
+  attended_question = model.mask_padding(attended_question, mask_q)
+  attended_passage = model.mask_padding(attended_passage, mask_p)
+  attention_q_plus_p = []
+  for t in range(max_passage_len):
+    attention_q_plus_p.append(attended_question + attended_passage[t])
+  transposed_Hq = torch.transpose(Hq, 0, 1)
+  Hf, Hb = [], []
+  for i in range(max_passage_len):
+    forward_idx = i
+    backward_idx = max_passage_len-i-1
+    gf = torch.tanh(attention_q_plus_p[forward_idx] + \
+           getattr(model, 'attend_passage_hidden_' + layer_no)(hf))
+    gb = torch.tanh(attention_q_plus_p[backward_idx] + \
+           getattr(model, 'attend_passage_hidden_' + layer_no)(hb))
+    alpha_f = getattr(model, 'passage_alpha_transform_' + layer_no)(gf)
+    alpha_b = getattr(model, 'passage_alpha_transform_' + layer_no)(gb)
+    alpha_f = torch.nn.functional.softmax(alpha_f, dim=0)
+    alpha_b = torch.nn.functional.softmax(alpha_b, dim=0)
+    weighted_Hq_f = torch.squeeze(torch.bmm(alpha_f.permute(1, 2, 0),
+                                  transposed_Hq), dim=1)
+    weighted_Hq_b = torch.squeeze(torch.bmm(alpha_b.permute(1, 2, 0),
+                                  transposed_Hq), dim=1)
+    zf = torch.cat((Hpi[forward_idx], weighted_Hq_f), dim=-1)
+    zb = torch.cat((Hpi[backward_idx], weighted_Hq_b), dim=-1)
+    hf, cf = getattr(model, 'passage_match_lstm_' + layer_no)(zf, (hf, cf))
+    hb, cb = getattr(model, 'passage_match_lstm_' + layer_no)(zb, (hb, cb))
+    hf = model.mask_padding(hf, mask_p[forward_idx])
+    hb = model.mask_padding(hb, mask_p[backward_idx])
+    cf = model.mask_padding(cf, mask_p[forward_idx])
+    cb = model.mask_padding(cb, mask_p[backward_idx])
+    Hf.append(hf)
+    Hb.append(hb)
+  Hb = Hb[::-1]
+  return torch.cat((torch.stack(Hf, dim=0), torch.stack(Hb, dim=0)), dim=-1)
+
+# Reference implementation of the passage self-matching layer, running the
+# forward and backward directions separately.
+def match_passage_passage_loop(model, layer_no, Hr, max_passage_len, batch_size,
+                               mask_p):
+  hf, cf = model.get_initial_lstm(batch_size, model.hidden_size // 2)
+  hb, cb = model.get_initial_lstm(batch_size, model.hidden_size // 2)
+  attended_passage = getattr(model, 'attend_self_passage_' + layer_no)(Hr)
+  attended_passage = model.mask_padding(attended_passage, mask_p)
+  transposed_Hr = torch.transpose(Hr, 0, 1)
+  Hf, Hb = [], []
+  for i in range(max_passage_len):
+    forward_idx = i
+    backward_idx = max_passage_len-i-1
+    gf = torch.tanh(attended_passage + \
+           getattr(model, 'attend_self_hidden_' + layer_no)(hf))
+    gb = torch.tanh(attended_passage + \
+           getattr(model, 'attend_self_hidden_' + layer_no)(hb))
+    alpha_f = getattr(model, 'self_alpha_transform_' + layer_no)(gf)
+    alpha_b = getattr(model, 'self_alpha_transform_' + layer_no)(gb)
+    alpha_f = torch.nn.functional.softmax(alpha_f, dim=0)
+    alpha_b = torch.nn.functional.softmax(alpha_b, dim=0)
+    weighted_Hr_f = torch.squeeze(torch.bmm(alpha_f.permute(1, 2, 0),
+                                  transposed_Hr), dim=1)
+    weighted_Hr_b = torch.squeeze(torch.bmm(alpha_b.permute(1, 2, 0),
+                                  transposed_Hr), dim=1)
+    zf = torch.cat((Hr[forward_idx], weighted_Hr_f), dim=-1)
+    zb = torch.cat((Hr[backward_idx], weighted_Hr_b), dim=-1)
+    hf, cf = getattr(model, 'self_match_lstm_' + layer_no)(zf, (hf, cf))
+    hb, cb = getattr(model, 'self_match_lstm_' + layer_no)(zb, (hb, cb))
+    hf = model.mask_padding(hf, mask_p[forward_idx])
+    hb = model.mask_padding(hb, mask_p[backward_idx])
+    cf = model.mask_padding(cf, mask_p[forward_idx])
+    cb = model.mask_padding(cb, mask_p[backward_idx])
+    Hf.append(hf)
+    Hb.append(hb)
+  Hb = Hb[::-1]
+  return torch.cat((torch.stack(Hf, dim=0), torch.stack(Hb, dim=0)), dim=-1)
+
+# Build a model with a single match layer, and random inputs to the layer.
+# Returns the model, and the arguments of its match layers.
+def match_layer_inputs(args, match_layer_type='recurrent'):
+  config = { 'embed_size': 10, 'vocab_size': 10,
+             'hidden_size': args.hidden_size,
+             'attention_size': args.attention_size,
+             'lr': 0.001, 'vectors_path': None, 'optimizer': 'Adamax',
+             'index_to_word': None, 'word_to_index': { '<pad>': 0 },
+             'use_pretrained': False, 'half_embeddings': False,
+             'cuda': args.cuda, 'dropout': 0.0,
+             'f1_loss_multiplier': 0.0, 'f1_loss_threshold': -1.0,
+             'num_pos_tags': 1, 'num_ner_tags': 1,
+             'num_preprocessing_layers': 1, 'num_postprocessing_layers': 0,
+             'num_matchlstm_layers': 1, 'num_selfmatch_layers': 1,
+             'match_layer_type': match_layer_type, 'compile_match': False,
+             'selfmatch_window': 0, 'selfmatch_global': 0 }
+  model = qNet(config)
+  if args.cuda:
+    model = model.cuda()
+  model.set_train()
+  rng = np.random.RandomState(1234)
+  passage_lens = rng.randint(args.passage_len // 2, args.passage_len + 1,
+                             args.batch_size)
+  passage_lens[0] = args.passage_len
+  question_lens = rng.randint(args.question_len // 2, args.question_len + 1,
+                              args.batch_size)
+  question_lens[0] = args.question_len
+  mask_p = model.get_mask(args.passage_len, passage_lens)
+  mask_q = model.get_mask(args.question_len, question_lens)
+  Hp = model.placeholder(
+         rng.randn(args.passage_len, args.batch_size, args.hidden_size))
+  Hq = model.placeholder(
+         rng.randn(args.question_len, args.batch_size, args.hidden_size))
+  return model, (Hp, Hq, args.passage_len, passage_lens, args.batch_size,
+                 mask_p, mask_q)
+
+# Time forward and backward passes through the given match layer function.
+def time_match_layer(args, model, fn):
+  times = []
+  for _ in range(args.num_runs):
+    model.zero_grad()
+    Hr, forward_t = timed(fn)
+    _, backward_t = timed(lambda: Hr.sum().backward())
+    if args.cuda:
+      torch.cuda.synchronize()
+    times.append((forward_t, backward_t))
+  forward_t, backward_t = np.median(np.array(times), axis=0)
+  return Hr, forward_t, backward_t
+
+def benchmark_match_layer(args):
+  model, inputs = match_layer_inputs(args)
+  print "Match layer: batch %d, passage length %d, question length %d, "\
+        "hidden size %d, attention size %d." % \
+        (args.batch_size, args.passage_len, args.question_len,
+         args.hidden_size, args.attention_size)
+  Hp, Hq, max_passage_len, _, batch_size, mask_p, _ = inputs
+  self_match_inputs = (Hp, max_passage_len, batch_size, mask_p)
+  for name, reference_fn, fn, layer_inputs in \
+        [ ("Question-passage", match_question_passage_loop,
+           model.match_question_passage, inputs),
+          ("Self-matching", match_passage_passage_loop,
+           model.match_passage_passage, self_match_inputs) ]:
+    reference_Hr, reference_forward_t, reference_backward_t = \
+      time_match_layer(args, model,
+                       lambda: reference_fn(model, '0', *layer_inputs))
+    print "%s reference: forward %.3fs (%.2f ms/step), backward %.3fs" % \
+          (name, reference_forward_t, 1000 * reference_forward_t / args.passage_len,
+           reference_backward_t)
+    # Run the model's layer as is, and compiled with TorchScript if available.
+    for compile_match in [ False, True ]:
+      if compile_match and not hasattr(torch.jit, 'script'):
+        continue
+      model.compile_match = compile_match
+      Hr, forward_t, backward_t = \
+        time_match_layer(args, model, lambda: fn('0', *layer_inputs))
+      if name == "Question-passage" and not compile_match:
+        recurrent_forward_t, recurrent_backward_t = forward_t, backward_t
+      print "%s%s: forward %.3fs (%.2f ms/step), backward %.3fs" % \
+            (name, " (compiled)" if compile_match else "", forward_t,
+             1000 * forward_t / args.passage_len, backward_t)
+      max_diff = (Hr - reference_Hr).abs().max().data.cpu().numpy()
+      print "Max difference %.2e. Forward speedup: %.1fx, backward speedup: %.1fx" % \
+            (max_diff, reference_forward_t / forward_t,
+             reference_backward_t / backward_t)
+    model.compile_match = False
+
+  # Question-passage layer with precomputed attention, on the same inputs.
+  precomputed_model, _ = match_layer_inputs(args, 'precomputed')
+  _, forward_t, backward_t = \
+    time_match_layer(args, precomputed_model,
+                     lambda: precomputed_model.match_question_passage('0', *inputs))
+  print "Question-passage (precomputed attention): forward %.3fs (%.2f ms/step), "\
+        "backward %.3fs" % \
+        (forward_t, 1000 * forward_t / args.passage_len, backward_t)
+  print "Forward speedup over the recurrent layer: %.1fx, backward speedup: %.1fx" % \
+        (recurrent_forward_t / forward_t, recurrent_backward_t / backward_t)
+
+  # Windowed self-matching, compared against full self-matching.
+  Hr, forward_t, backward_t = \
+    time_match_layer(args, model,
+                     lambda: model.match_passage_passage('0', *self_match_inputs))
+  model.selfmatch_window = args.selfmatch_window
+  model.selfmatch_global = args.selfmatch_global
+  windowed_Hr, windowed_forward_t, windowed_backward_t = \
+    time_match_layer(args, model,
+                     lambda: model.match_passage_passage('0', *self_match_inputs))
+  print "Windowed self-matching (window %d, %d summaries): forward %.3fs "\
+        "(%.2f ms/step), backward %.3fs" % \
+        (args.selfmatch_window, args.selfmatch_global, windowed_forward_t,
+         1000 * windowed_forward_t / args.passage_len, windowed_backward_t)
+  print "Forward speedup over full self-matching: %.1fx, backward speedup: %.1fx" % \
+        (forward_t / windowed_forward_t, backward_t / windowed_backward_t)
+  model.selfmatch_window = 0
+#------------------------------------------------------------------------------#
+
+if __name__ == "__main__":
+  args = init_parser().parse_args()
+  if args.benchmark == "match_layer":
+    benchmark_match_layer(args)
+    sys.exit(0)
+
+  assert args.train_pickle is not None, "Train data arrays must be provided."
+  print "Reading data from %s." % args.train_pickle
+  data = Data().read_from_arrays(args.train_pickle)
+  if args.max_examples >= 0:
+    data.data = data.data[:args.max_examples]
+  print "Done."
+  sys.stdout.flush()
+
+  if args.benchmark == "f1_matrix":
+    benchmark_f1_matrix(args, data)
+  elif args.benchmark == "get_batch":
+    benchmark_get_batch(args, data)
+  else:
+    print "Invalid benchmark:", args.benchmark
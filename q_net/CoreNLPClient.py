@@ -0,0 +1,318 @@
+import hashlib
+import json
+import random
+import requests
+import sqlite3
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+# Documents within a request are separated by this string. With
+# ssplit.newlineIsSentenceBreak set to 'two', no sentence spans two documents.
+document_separator = u"\n\n"
+
+class AnnotationCache:
+  ''' Persistent SQLite cache of document annotations, keyed by a hash of the
+      annotator set and the document text. Least recently used entries are
+      evicted when the total size of stored annotations exceeds max_bytes.
+      The cache can be used from multiple threads: all accesses to the
+      connection and the access counter are serialized by a lock.'''
+
+  def __init__(self, path, max_bytes=1024 * 1024 * 1024):
+    self.path = path
+    self.max_bytes = max_bytes
+    self.connection = sqlite3.connect(path, check_same_thread=False)
+    self.lock = threading.Lock()
+    self.connection.execute(
+      "CREATE TABLE IF NOT EXISTS annotations (key TEXT PRIMARY KEY, "
+      "value TEXT, size INTEGER, last_used INTEGER)")
+    self.connection.execute(
+      "CREATE INDEX IF NOT EXISTS annotations_last_used ON annotations (last_used)")
+    self.connection.commit()
+    # Access counter used to order entries for eviction.
+    self.clock = self.connection.execute(
+      "SELECT COALESCE(MAX(last_used), 0) FROM annotations").fetchone()[0]
+    # Total size of stored annotations, kept up to date on every change so
+    # that the table only needs to be scanned when entries must be evicted.
+    self.total_bytes = self.connection.execute(
+      "SELECT COALESCE(SUM(size), 0) FROM annotations").fetchone()[0]
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def key(self, annotators, text):
+    return hashlib.sha1(annotators.encode('utf8') + b"\0" +
+                        text.encode('utf8')).hexdigest()
+
+  # Returns the cached annotation for each text, or None if it isn't cached.
+  def get_all(self, annotators, texts):
+    annotations, used = [], []
+    with self.lock:
+      for text in texts:
+        key = self.key(annotators, text)
+        row = self.connection.execute(
+          "SELECT value FROM annotations WHERE key = ?", (key,)).fetchone()
+        if row is None:
+          self.misses += 1
+          annotations.append(None)
+          continue
+        self.hits += 1
+        self.clock += 1
+        used.append((self.clock, key))
+        annotations.append(tuple(json.loads(row[0])))
+      self.connection.executemany(
+        "UPDATE annotations SET last_used = ? WHERE key = ?", used)
+      self.connection.commit()
+    return annotations
+
+  # Store the given annotations, skipping failed (None) ones.
+  def put_all(self, annotators, texts, annotations):
+    rows = {}
+    with self.lock:
+      for text, annotation in zip(texts, annotations):
+        if annotation is None:
+          continue
+        key = self.key(annotators, text)
+        value = json.dumps(annotation)
+        self.clock += 1
+        rows[key] = (key, value, len(value), self.clock)
+      # Replaced entries no longer count towards the total size.
+      for key, _, size, _ in rows.itervalues():
+        row = self.connection.execute(
+          "SELECT size FROM annotations WHERE key = ?", (key,)).fetchone()
+        self.total_bytes += size - (row[0] if row is not None else 0)
+      self.connection.executemany(
+        "INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?)", rows.values())
+      self.evict()
+      self.connection.commit()
+
+  # Evict least recently used entries until the cache is within 90% of its
+  # size limit. Must be called with the lock held.
+  def evict(self):
+    if self.total_bytes <= self.max_bytes:
+      return
+    target = int(0.9 * self.max_bytes)
+    evicted = []
+    for key, size in self.connection.execute(
+        "SELECT key, size FROM annotations ORDER BY last_used"):
+      if self.total_bytes <= target:
+        break
+      evicted.append((key,))
+      self.total_bytes -= size
+    self.connection.executemany("DELETE FROM annotations WHERE key = ?", evicted)
+    self.evictions += len(evicted)
+
+  def print_stats(self):
+    print "Annotation cache: %d hits, %d misses, %d evictions." % \
+          (self.hits, self.misses, self.evictions)
+
+class CoreNLPClient:
+  ''' Client for a running StanfordCoreNLPServer, that annotates many documents
+      per HTTP request, over a bounded pool of keep-alive connections.'''
+
+  def __init__(self, url, annotators='tokenize,ssplit,pos,ner', pool_size=8,
+               max_batch_docs=64, max_batch_chars=50000, max_tries=10,
+               backoff_start=0.5, backoff_max=30.0, timeout=600, cache=None):
+    self.url = url
+    self.cache = cache
+    self.annotators = annotators
+    self.pool_size = pool_size
+    self.max_batch_docs = max_batch_docs
+    self.max_batch_chars = max_batch_chars
+    self.max_tries = max_tries
+    self.backoff_start = backoff_start
+    self.backoff_max = backoff_max
+    self.timeout = timeout
+
+    # A single session is shared by all threads. Its connection pool blocks
+    # when all pool_size connections are in use, which bounds the number of
+    # in-flight requests to the server.
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=pool_size,
+                                            pool_block=True)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+
+    self.stats_lock = threading.Lock()
+    self.reset_stats()
+
+  def reset_stats(self):
+    with self.stats_lock:
+      self.num_requests = 0
+      self.num_retries = 0
+      self.num_failed_docs = 0
+      self.num_docs = 0
+      self.num_chars = 0
+      self.request_time = 0.0
+      self.start_time = time.time()
+
+  # Returns a dictionary of throughput statistics since the last reset.
+  def stats(self):
+    with self.stats_lock:
+      elapsed = max(time.time() - self.start_time, 1e-6)
+      return { 'requests': self.num_requests,
+               'retries': self.num_retries,
+               'failed_docs': self.num_failed_docs,
+               'docs': self.num_docs,
+               'chars': self.num_chars,
+               'request_time': self.request_time,
+               'elapsed_time': elapsed,
+               'docs_per_sec': self.num_docs / elapsed,
+               'chars_per_sec': self.num_chars / elapsed }
+
+  def print_stats(self):
+    stats = self.stats()
+    print "CoreNLP: %d docs (%d failed) in %d requests (%d retries), "\
+          "%.1f docs/s, %.0f chars/s." % \
+          (stats['docs'], stats['failed_docs'], stats['requests'],
+           stats['retries'], stats['docs_per_sec'], stats['chars_per_sec'])
+    if self.cache is not None:
+      self.cache.print_stats()
+
+  def properties(self):
+    return { 'annotators': self.annotators,
+             'outputFormat': 'json',
+             'ssplit.newlineIsSentenceBreak': 'two' }
+
+  # Send a single annotation request. Connection failures, timeouts and busy
+  # (503) responses are retried with exponential backoff, and raise a
+  # requests.exceptions.RequestException once all tries fail.
+  # Returns the parsed json response, or None if the server failed to annotate
+  # the text.
+  def request(self, text):
+    params = { 'properties': json.dumps(self.properties()) }
+    for tries in range(self.max_tries):
+      start_t = time.time()
+      try:
+        response = self.session.post(self.url, params=params,
+                                     data=text.encode('utf8'),
+                                     timeout=self.timeout)
+        if response.status_code == 503:
+          response.raise_for_status()
+      except requests.exceptions.RequestException:
+        with self.stats_lock:
+          self.num_retries += 1
+        if tries + 1 == self.max_tries:
+          raise
+        backoff = min(self.backoff_start * (2 ** tries), self.backoff_max)
+        time.sleep(backoff * random.uniform(0.5, 1.0))
+        continue
+      with self.stats_lock:
+        self.num_requests += 1
+        self.request_time += time.time() - start_t
+      if not response.ok:
+        return None
+      try:
+        annotation = response.json()
+      except ValueError:
+        return None
+      return annotation if type(annotation) == dict else None
+
+  # Split the tokens of a multi-document annotation back into documents, using
+  # the character offsets of each token.
+  # Returns a list of (tokens, pos_tags, ner_tags, char_offsets) per document.
+  def split_annotation(self, annotation, doc_starts):
+    if 'sentences' in annotation:
+      tokens = [ token for sentence in annotation['sentences'] \
+                   for token in sentence['tokens'] ]
+    else:
+      tokens = annotation['tokens']
+    docs = [ ([], [], [], []) for _ in doc_starts ]
+    doc_idx = 0
+    for token in tokens:
+      while doc_idx + 1 < len(doc_starts) and \
+            token['characterOffsetBegin'] >= doc_starts[doc_idx + 1]:
+        doc_idx += 1
+      doc_start = doc_starts[doc_idx]
+      words, pos_tags, ner_tags, char_offsets = docs[doc_idx]
+      words.append(token['word'])
+      pos_tags.append(token.get('pos'))
+      ner_tags.append(token.get('ner'))
+      char_offsets.append((token['characterOffsetBegin'] - doc_start,
+                           token['characterOffsetEnd'] - doc_start))
+    return docs
+
+  # Annotate a batch of documents in a single request. Batches the server
+  # fails to annotate are split in two and retried, to isolate bad documents.
+  # If the server can't be reached, all documents of the batch fail, without
+  # splitting it.
+  def annotate_batch(self, texts):
+    doc_starts = []
+    offset = 0
+    for text in texts:
+      doc_starts.append(offset)
+      offset += len(text) + len(document_separator)
+    try:
+      annotation = self.request(document_separator.join(texts))
+    except requests.exceptions.RequestException as e:
+      print "Failed for %d documents: %s" % (len(texts), e)
+      with self.stats_lock:
+        self.num_failed_docs += len(texts)
+      return [ None ] * len(texts)
+    if annotation is not None:
+      with self.stats_lock:
+        self.num_docs += len(texts)
+        self.num_chars += offset
+      return self.split_annotation(annotation, doc_starts)
+    if len(texts) > 1:
+      half = len(texts) // 2
+      return self.annotate_batch(texts[:half]) + self.annotate_batch(texts[half:])
+    print "Failed for %s" % texts[0]
+    with self.stats_lock:
+      self.num_failed_docs += 1
+    return [ None ]
+
+  # Group document indices into batches bounded by number of documents and
+  # total number of characters.
+  def make_batches(self, texts):
+    batches, batch, batch_chars = [], [], 0
+    for idx, text in enumerate(texts):
+      if len(batch) > 0 and \
+         (len(batch) >= self.max_batch_docs or \
+          batch_chars + len(text) > self.max_batch_chars):
+        batches.append(batch)
+        batch, batch_chars = [], 0
+      batch.append(idx)
+      batch_chars += len(text)
+    if len(batch) > 0:
+      batches.append(batch)
+    return batches
+
+  # Annotate all given documents, with up to pool_size requests in flight.
+  # Documents found in the cache, if any, are not sent to the server.
+  # Returns a list with a (tokens, pos_tags, ner_tags, char_offsets) tuple, or
+  # None if annotation failed, for each document.
+  def annotate_all(self, texts):
+    texts = [ text if type(text) == unicode else text.decode('utf8') \
+                for text in texts ]
+    annotations = [ None ] * len(texts)
+    if self.cache is not None:
+      annotations = self.cache.get_all(self.annotators, texts)
+    to_annotate = [ idx for idx, annotation in enumerate(annotations) \
+                      if annotation is None ]
+    batches = [ [ to_annotate[idx] for idx in batch ] for batch in \
+                  self.make_batches([ texts[idx] for idx in to_annotate ]) ]
+    annotate_batch = \
+      lambda batch: self.annotate_batch([ texts[idx] for idx in batch ])
+    if len(batches) <= 1:
+      annotated_batches = map(annotate_batch, batches)
+    else:
+      pool = ThreadPool(min(self.pool_size, len(batches)))
+      try:
+        annotated_batches = pool.map(annotate_batch, batches, chunksize=1)
+      finally:
+        pool.close()
+        pool.join()
+    for batch, annotated_batch in zip(batches, annotated_batches):
+      for idx, annotation in zip(batch, annotated_batch):
+        annotations[idx] = annotation
+    if self.cache is not None:
+      self.cache.put_all(self.annotators, [ texts[idx] for idx in to_annotate ],
+                         [ annotations[idx] for idx in to_annotate ])
+    return annotations
+
+  # Annotate a single document.
+  def annotate(self, text):
+    return self.annotate_all([ text ])[0]
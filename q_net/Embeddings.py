@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+import argparse
+import io
+import json
+import numpy as np
+import os
+import sys
+import time
+
+# A converted vector store is a float32 matrix, <prefix>.npy, with one row per
+# word, and a json list of the words of each row, <prefix>.words.json.
+def store_paths(prefix):
+  return prefix + ".npy", prefix + ".words.json"
+
+# Whether the given vectors path points to a converted vector store (its .npy
+# matrix), rather than a text vectors file.
+def is_vector_store(path):
+  return path.endswith(".npy")
+
+def init_parser():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--vectors_path', default='../../data/fasttext/crawl-300d-2M.vec',
+                      help = "Path to the pre-trained vectors text file to convert.")
+  parser.add_argument('--output_prefix',
+                      help = "Prefix of the converted vector store files. Defaults to the vectors "\
+                             "path, without its extension.")
+  return parser
+
+# Get the number of vectors and their dimensions in a text vectors file, from
+# its header line if present (as in fastText files), or by reading it.
+def vectors_shape(vectors_path):
+  with io.open(vectors_path, encoding='utf8', errors='replace') as fin:
+    first_line = fin.readline().split()
+    if len(first_line) == 2 and all(value.isdigit() for value in first_line):
+      return int(first_line[0]), int(first_line[1]), True
+    num_vectors = 1 + sum(1 for _ in fin)
+  return num_vectors, len(first_line) - 1, False
+
+# Convert a text vectors file, with a word and its vector on each line, into a
+# vector store. Only the first vector of repeated words is kept.
+def convert_vectors(vectors_path, output_prefix):
+  num_vectors, embed_size, has_header = vectors_shape(vectors_path)
+  matrix_path, words_path = store_paths(output_prefix)
+  matrix = np.lib.format.open_memmap(matrix_path + ".tmp", mode='w+',
+                                     dtype=np.float32,
+                                     shape=(num_vectors, embed_size))
+  words, seen = [], set()
+  with io.open(vectors_path, encoding='utf8', errors='replace') as fin:
+    if has_header:
+      fin.readline()
+    for line in fin:
+      word, values = line.rstrip().split(" ", 1)
+      if word in seen:
+        continue
+      values = np.fromstring(values, dtype=np.float32, sep=" ")
+      if len(values) != embed_size:
+        continue
+      seen.add(word)
+      matrix[len(words)] = values
+      words.append(word)
+      if len(words) % 100000 == 0:
+        print "\rConverted %d of %d vectors." % (len(words), num_vectors),
+        sys.stdout.flush()
+  print "\rConverted %d of %d vectors." % (len(words), num_vectors)
+
+  # Drop rows of skipped lines.
+  if len(words) < num_vectors:
+    trimmed = np.lib.format.open_memmap(matrix_path, mode='w+', dtype=np.float32,
+                                        shape=(len(words), embed_size))
+    trimmed[:] = matrix[:len(words)]
+    trimmed.flush()
+    del trimmed, matrix
+    os.remove(matrix_path + ".tmp")
+  else:
+    matrix.flush()
+    del matrix
+    os.rename(matrix_path + ".tmp", matrix_path)
+  with io.open(words_path, "w", encoding='utf8') as fout:
+    fout.write(json.dumps(words, ensure_ascii=False))
+
+# Read the vectors of the given vocabulary from a vector store. The matrix is
+# memory-mapped, so only the pages of the gathered rows are read, and they are
+# shared between processes reading the same store.
+# Returns a (vocab_size, embed_size) float32 matrix, with zero vectors for
+# words without a pre-trained vector, and a boolean array of whether each word
+# has one.
+def read_vectors(path, word_to_index, vocab_size):
+  matrix_path, words_path = store_paths(path[:-len(".npy")])
+  matrix = np.load(matrix_path, mmap_mode='r')
+  with io.open(words_path, encoding='utf8') as fin:
+    words = json.loads(fin.read())
+  vocab_idxs, rows = [], []
+  for row, word in enumerate(words):
+    if word in word_to_index:
+      vocab_idxs.append(word_to_index[word])
+      rows.append(row)
+  embeddings = np.zeros((vocab_size, matrix.shape[1]), dtype=np.float32)
+  # Gather rows in increasing order, for sequential reads.
+  embeddings[vocab_idxs] = matrix[rows]
+  known = np.zeros(vocab_size, dtype=bool)
+  known[vocab_idxs] = True
+  return embeddings, known
+
+if __name__ == "__main__":
+  args = init_parser().parse_args()
+  output_prefix = args.output_prefix
+  if output_prefix is None:
+    output_prefix = args.vectors_path.rsplit(".", 1)[0]
+  start_t = time.time()
+  print "Converting %s to %s." % (args.vectors_path, store_paths(output_prefix)[0])
+  convert_vectors(args.vectors_path, output_prefix)
+  print "Done in %.2fs." % (time.time() - start_t)
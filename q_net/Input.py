@@ -1,65 +1,202 @@
-import cPickle as pickle
-import gzip
+import bisect
+import collections
+import io
 import json
 import numpy
+import os
+import Queue
 import string
 import sys
-import time
+import threading
 
-from joblib import Parallel, delayed
-from pycorenlp import StanfordCoreNLP
-from tqdm import tqdm
+from multiprocessing.pool import ThreadPool
+
+from CoreNLPClient import AnnotationCache, CoreNLPClient
 
 # Define URL of running StanfordCoreNLPServer.
 corenlp_url = 'http://localhost:9001'
-max_tries = 10
-
-def word_tokenize(idx, sentence):
-  stanford_corenlp = StanfordCoreNLP(corenlp_url)
-  tries = 0
-  while True:
-    try:
-      annotation = stanford_corenlp.annotate(
-        sentence.encode('utf8'),
-        properties = { 'annotators': 'tokenize',
-                       'outputFormat': 'json' })
-      assert type(annotation) == dict
-      break
-    except Exception:
-      time.sleep(1)
-      tries += 1
-      if tries == 10:
-        return (idx, None)
-      pass
-  tokens = []
-  tokens.extend([ token['word'] for token in annotation['tokens'] ])
-  return (idx, tokens)
+tag_annotators = 'tokenize,ssplit,pos,ner'
+# Paragraphs are sent for annotation in chunks of this size while the input
+# file is being read, with up to max_queued_articles articles parsed ahead, and
+# up to max_chunks_in_flight chunks being annotated at a time.
+paragraph_chunk_size = 256
+max_queued_articles = 64
+max_chunks_in_flight = 4
+# Maximum number of concurrent requests to the CoreNLP server.
+corenlp_pool_size = 8
+
+# CoreNLP clients are created once per process and annotator set, so that
+# their connections are reused across calls.
+corenlp_clients = {}
+corenlp_clients_lock = threading.Lock()
+# Optional on-disk cache of annotations, shared by all clients.
+annotation_cache = None
+
+def set_annotation_cache(path, max_mb):
+  global annotation_cache
+  annotation_cache = AnnotationCache(path, max_mb * 1024 * 1024)
+  for client in corenlp_clients.values():
+    client.cache = annotation_cache
+
+def get_corenlp_client(annotators):
+  with corenlp_clients_lock:
+    if not annotators in corenlp_clients:
+      corenlp_clients[annotators] = CoreNLPClient(corenlp_url, annotators,
+                                                  pool_size = corenlp_pool_size,
+                                                  cache = annotation_cache)
+    return corenlp_clients[annotators]
 
 def tokenize_and_tag(idx, sentence):
-  stanford_corenlp = StanfordCoreNLP(corenlp_url)
-  tries = 0
-  while True:
-    try:
-      annotation = stanford_corenlp.annotate(
-        sentence.encode('utf8'),
-        properties = { 'annotators': 'tokenize,pos,ner',
-                       'outputFormat': 'json' })
-      assert type(annotation) == dict
-      break
-    except Exception:
-      time.sleep(1)
-      tries += 1
-      if tries == 10:
-        print "Failed for %s" % sentence
-        return (idx, None, None, None)
-      pass
-  tokens, pos_tags, ner_tags = [], [], []
-  for sentence in annotation['sentences']:
-    tokens.extend([ token['word'] for token in sentence['tokens'] ])
-    pos_tags.extend([ token['pos'] for token in sentence['tokens'] ])
-    ner_tags.extend([ token['ner'] for token in sentence['tokens'] ])
+  annotation = get_corenlp_client(tag_annotators).annotate(sentence)
+  if annotation is None:
+    return (idx, None, None, None)
+  tokens, pos_tags, ner_tags, _ = annotation
   return (idx, tokens, pos_tags, ner_tags)
 
+# Annotate all the given texts with batched requests to the CoreNLP server.
+# Returns lists of tokens, pos tags, ner tags and (begin, end) character
+# offsets of tokens, with None for failed texts.
+def tokenize_and_tag_all(texts):
+  annotations = get_corenlp_client(tag_annotators).annotate_all(texts)
+  annotations = [ annotation if annotation is not None \
+                             else (None, None, None, None) \
+                    for annotation in annotations ]
+  if len(annotations) == 0:
+    return [], [], [], []
+  tokens, pos_tags, ner_tags, char_offsets = zip(*annotations)
+  return list(tokens), list(pos_tags), list(ner_tags), list(char_offsets)
+
+# Annotate a chunk of paragraphs and the questions on them.
+def annotate_chunk(paragraphs, questions):
+  return tokenize_and_tag_all(paragraphs), tokenize_and_tag_all(questions)
+
+# Print and reset CoreNLP throughput statistics.
+def print_corenlp_stats():
+  client = get_corenlp_client(tag_annotators)
+  client.print_stats()
+  client.reset_stats()
+
+# Iterate over the given iterable in a background thread, which stays up to
+# max_queued items ahead of the consumer. The thread stops once the consumer
+# stops iterating, when the generator is closed.
+def iter_in_background(iterable, max_queued):
+  queue = Queue.Queue(max_queued)
+  end = object()
+  stop = threading.Event()
+  # Wait for space in the queue, unless the consumer has stopped.
+  # Returns whether the item was queued.
+  def put(item):
+    while not stop.is_set():
+      try:
+        queue.put(item, timeout=0.1)
+        return True
+      except Queue.Full:
+        pass
+    return False
+  def produce():
+    try:
+      for item in iterable:
+        if not put((item, None)):
+          return
+    except Exception as e:
+      put((None, e))
+      return
+    put((end, None))
+  thread = threading.Thread(target=produce)
+  thread.daemon = True
+  thread.start()
+  try:
+    while True:
+      item, error = queue.get()
+      if error is not None:
+        raise error
+      if item is end:
+        break
+      yield item
+  finally:
+    stop.set()
+
+# Incrementally read the articles of SQuAD json files, without holding the
+# whole parsed file in memory. A file may hold several concatenated SQuAD json
+# objects. Files with a .jsonl extension are read as one article per line.
+def iter_squad_articles(filename, chunk_size=1 << 20):
+  if filename.endswith(".jsonl"):
+    with io.open(filename, 'r', encoding='utf-8') as input_file:
+      for line in input_file:
+        if line.strip():
+          yield json.loads(line)
+    return
+
+  decoder = json.JSONDecoder()
+  with io.open(filename, 'r', encoding='utf-8') as input_file:
+    state = { 'buffer': u"", 'pos': 0, 'eof': False }
+
+    def read_more():
+      chunk = input_file.read(chunk_size)
+      state['buffer'] = state['buffer'][state['pos']:] + chunk
+      state['pos'] = 0
+      state['eof'] = len(chunk) == 0
+
+    # Get the next non-whitespace character, without consuming it.
+    def peek():
+      while True:
+        buf, pos = state['buffer'], state['pos']
+        while pos < len(buf) and buf[pos].isspace():
+          pos += 1
+        state['pos'] = pos
+        if pos < len(buf):
+          return buf[pos]
+        if state['eof']:
+          return None
+        read_more()
+
+    def expect(chars):
+      char = peek()
+      assert char is not None and char in chars, \
+             "Malformed json in %s: expected '%s', got '%s'." % (filename, chars, char)
+      state['pos'] += 1
+      return char
+
+    # Decode the next json value. Values ending at the buffer boundary may be
+    # truncated (e.g. numbers), so they are only accepted when followed by a
+    # delimiter.
+    def decode():
+      peek()
+      while True:
+        try:
+          value, end = decoder.raw_decode(state['buffer'], state['pos'])
+          if state['eof'] or (end < len(state['buffer']) and \
+                              (state['buffer'][end] in u",:]}" or \
+                               state['buffer'][end].isspace())):
+            state['pos'] = end
+            return value
+        except ValueError:
+          if state['eof']:
+            raise
+        read_more()
+
+    while peek() is not None:
+      expect('{')
+      if peek() == '}':
+        expect('}')
+        continue
+      while True:
+        key = decode()
+        expect(':')
+        if key == 'data':
+          expect('[')
+          if peek() == ']':
+            expect(']')
+          else:
+            while True:
+              yield decode()
+              if expect(',]') == ']':
+                break
+        else:
+          decode()
+        if expect(',}') == '}':
+          break
+
 class Dictionary:
   def __init__(self, lowercase=True, remove_punctuation=True,
                answer_start="ANSWERSTART", answer_end="ANSWEREND"):
@@ -157,30 +294,54 @@ def f1_score(start, end, ans_start_idx, ans_end_idx):
   recall = intersection/float(true)
   return 2 * precision * recall / (precision + recall)
 
+# Get the F1 scores of all candidate ranges (start, end) against the true
+# range, for a paragraph of length para_len. Only starts in [0, ans_end_idx]
+# and ends in [ans_start_idx, para_len) can overlap the true range, so the
+# returned matrix has shape (ans_end_idx+1, para_len-ans_start_idx), with
+# column j holding end index ans_start_idx+j. Values are identical to calling
+# f1_score on each cell, as the same floating point operations are performed.
+def f1_matrix(ans_start_idx, ans_end_idx, para_len):
+  starts = numpy.arange(ans_end_idx + 1)[:, None]
+  ends = numpy.arange(ans_start_idx, para_len)[None, :]
+  intersection = numpy.minimum(ends, ans_end_idx) - \
+                 numpy.maximum(starts, ans_start_idx) + 1
+  true = ans_end_idx - ans_start_idx + 1
+  ours = ends - starts + 1
+  valid = ends >= starts
+  # Invalid cells (end < start) are given dummy lengths to avoid dividing by
+  # zero, and are zeroed out at the end.
+  intersection = numpy.where(valid, intersection, 1)
+  ours = numpy.where(valid, ours, 1)
+  precision = intersection / ours.astype(numpy.float64)
+  recall = intersection / float(true)
+  f1 = 2 * precision * recall / (precision + recall)
+  return numpy.where(valid, f1, 0.0)
+
+# Get the indices of the first and last tokens overlapping the character range
+# [start_char, end_char), given the (begin, end) character offsets of tokens.
+def get_token_span(char_offsets, start_char, end_char):
+  token_begins = [ begin for begin, _ in char_offsets ]
+  token_ends = [ end for _, end in char_offsets ]
+  return [ bisect.bisect_right(token_ends, start_char),
+           bisect.bisect_left(token_begins, end_char) - 1 ]
+
 # Create question-answer tuple with required information.
+# Answer spans are located using the character offsets of paragraph tokens,
+# so that paragraphs need not be tokenized again for each answer.
 def create_data(qid, para_text, tokenized_para, tokenized_para_words,
-                processed_question, dictionary, question, answers):
+                para_char_offsets, processed_question, question, answers):
   missed = 0
   processed_answers = []
   sentence_idxs = []
   for answer in answers:
     start_idx = answer['answer_start']
     end_idx = start_idx + len(answer['text'])
-    para_text_modified = para_text[:start_idx] + " " + \
-                         dictionary.answer_start + " " + \
-                         para_text[start_idx:end_idx] + " " + \
-                         dictionary.answer_end + " " + \
-                         para_text[end_idx:]
-    answer_idxs = \
-      [ i for i,idx in \
-          enumerate([ dictionary.get_index(w) for w in \
-                        word_tokenize(None, para_text_modified)[1] ]) \
-          if idx == -1 ]
-    answer_idxs[1] -= 2
+    answer_idxs = get_token_span(para_char_offsets, start_idx, end_idx)
 
     # Valid answers should lie within bounds.
     if answer_idxs[0] < 0 or answer_idxs[0] >= len(tokenized_para) \
-       or answer_idxs[1] < 0 or answer_idxs[1] >= len(tokenized_para):
+       or answer_idxs[1] < 0 or answer_idxs[1] >= len(tokenized_para) \
+       or answer_idxs[1] < answer_idxs[0]:
       print "\n" * 3
       print "Invalid answer \"%s\" ignored. (%d,%d)\n" % \
             (answer['text'], answer_idxs[0], answer_idxs[1])
@@ -205,15 +366,10 @@ def create_data(qid, para_text, tokenized_para, tokenized_para_words,
 
   # Create question-answer tuples.
   data = []
+  # F1 target matrices are not stored, and are instead created from the answer
+  # indices when batches are built (see create_f1_matrices).
   for processed_answer, sentence_idx in zip(processed_answers, sentence_idxs):
-    f1_partial_matrix = numpy.zeros((processed_answer[1]+1,
-                                     len(tokenized_para)-processed_answer[0]))
-    for start in range(0,processed_answer[1]+1):
-      for end in range(max(start,processed_answer[0]),len(tokenized_para)):
-        f1_partial_matrix[start, end-processed_answer[0]] = \
-          f1_score(start, end, processed_answer[0], processed_answer[1])
-    data.append([processed_question, processed_answer, qid,
-                 f1_partial_matrix, sentence_idx])
+    data.append([processed_question, processed_answer, qid, sentence_idx])
 
   return data, missed
 
@@ -236,6 +392,7 @@ class Data:
     self.tokenized_para_words = []
     self.paras_pos_tags = []
     self.paras_ner_tags = []
+    self.paras_char_offsets = []
     self.question_to_paragraph = {}
     self.data = []
     self.missed = 0
@@ -254,17 +411,95 @@ class Data:
     del self.question_pos_tags
     del self.paras_pos_tags
     del self.paras_ner_tags
-
-  def dump_pickle(self, filename):
-    with gzip.open(filename + ".gz", 'wb') as fout:
-      pickle.dump(self, fout)
-      fout.close()
-
-  def read_from_pickle(self, filename):
-    with gzip.open(filename + ".gz", 'rb') as fin:
-      self = pickle.load(fin)
-      fin.close()
-      return self
+    del self.paras_char_offsets
+
+  # Dump the data in a columnar format, as numpy arrays in the given directory:
+  # flat token/tag arrays with offsets for paragraphs and questions, a table of
+  # examples and the vocabulary. See read_from_arrays.
+  def dump_arrays(self, dirname):
+    if not os.path.exists(dirname):
+      os.makedirs(dirname)
+    def save(name, array):
+      numpy.save(os.path.join(dirname, name + ".npy"), array)
+
+    values, offsets = ragged_to_arrays(self.tokenized_paras)
+    save("paragraph_offsets", offsets)
+    save("paragraph_tokens", values)
+    save("paragraph_pos_tags", ragged_to_arrays(self.paras_pos_tags)[0])
+    save("paragraph_ner_tags", ragged_to_arrays(self.paras_ner_tags)[0])
+    save("paragraph_char_offsets",
+         ragged_to_arrays(self.paras_char_offsets, (2,))[0])
+
+    qids = self.questions_tokenized.keys()
+    qid_to_row = dict(zip(qids, range(len(qids))))
+    values, offsets = \
+      ragged_to_arrays([ self.questions_tokenized[qid] for qid in qids ])
+    save("question_offsets", offsets)
+    save("question_tokens", values)
+    save("question_pos_tags",
+         ragged_to_arrays([ self.question_pos_tags[qid] for qid in qids ])[0])
+    save("question_ner_tags",
+         ragged_to_arrays([ self.question_ner_tags[qid] for qid in qids ])[0])
+    save("question_paragraphs",
+         numpy.array([ self.question_to_paragraph[qid] for qid in qids ],
+                     dtype=numpy.int32))
+
+    # examples[i] = (question row, answer start, answer end, sentence start,
+    #                sentence end)
+    save("examples",
+         numpy.array([ [ qid_to_row[example[2]] ] + list(example[1]) + \
+                         list(example[3]) for example in self.data ],
+                     dtype=numpy.int32).reshape(-1, 5))
+
+    with open(os.path.join(dirname, "vocab.json"), "w") as fout:
+      json.dump({ 'index_to_word': self.dictionary.index_to_word,
+                  'pos_tags': self.dictionary.pos_tags,
+                  'ner_tags': self.dictionary.ner_tags,
+                  'lowercase': self.dictionary.lowercase,
+                  'remove_punctuation': self.dictionary.remove_punctuation,
+                  'mutable': self.dictionary.mutable }, fout)
+    with open(os.path.join(dirname, "meta.json"), "w") as fout:
+      json.dump({ 'qids': qids, 'missed': self.missed }, fout)
+
+  # Read data dumped by dump_arrays. Arrays are memory-mapped, so that reading
+  # is near instant, and pages are shared between processes reading them.
+  def read_from_arrays(self, dirname):
+    def load(name):
+      return numpy.load(os.path.join(dirname, name + ".npy"), mmap_mode='r')
+
+    with open(os.path.join(dirname, "vocab.json")) as fin:
+      vocab = json.load(fin)
+    self.dictionary = Dictionary(vocab['lowercase'], vocab['remove_punctuation'])
+    self.dictionary.index_to_word = vocab['index_to_word']
+    self.dictionary.word_to_index = \
+      dict(zip(vocab['index_to_word'], range(len(vocab['index_to_word']))))
+    self.dictionary.pos_tags = vocab['pos_tags']
+    self.dictionary.ner_tags = vocab['ner_tags']
+    self.dictionary.mutable = vocab['mutable']
+    with open(os.path.join(dirname, "meta.json")) as fin:
+      meta = json.load(fin)
+    qids = meta['qids']
+    self.missed = meta['missed']
+
+    offsets = load("paragraph_offsets")
+    self.tokenized_paras = RaggedArray(load("paragraph_tokens"), offsets)
+    self.paras_pos_tags = RaggedArray(load("paragraph_pos_tags"), offsets)
+    self.paras_ner_tags = RaggedArray(load("paragraph_ner_tags"), offsets)
+    self.paras_char_offsets = RaggedArray(load("paragraph_char_offsets"), offsets)
+
+    offsets = load("question_offsets")
+    self.questions_tokenized = RaggedArray(load("question_tokens"), offsets, qids)
+    self.question_pos_tags = RaggedArray(load("question_pos_tags"), offsets, qids)
+    self.question_ner_tags = RaggedArray(load("question_ner_tags"), offsets, qids)
+    self.question_to_paragraph = \
+      dict(zip(qids, load("question_paragraphs").tolist()))
+
+    examples = load("examples")
+    self.data = [ [ self.questions_tokenized[qids[example[0]]],
+                    [ example[1], example[2] ], qids[example[0]],
+                    (example[3], example[4]) ] \
+                    for example in examples.tolist() ]
+    return self
 
   def get_ids(self, tokenized_text):
     return [ self.dictionary.add_or_get_index(word) \
@@ -274,10 +509,12 @@ class Data:
     return [ self.dictionary.get_index(word) \
                for word in tokenized_text ]
 
+  # Add a paragraph, and its questions. Returns the ids of added questions.
   def add_paragraph(self, paragraph):
     para_text = paragraph['context']
     para_qas = paragraph['qas']
 
+    qids = []
     for qa in para_qas:
       # Questions of length <= 2 words are ignored
       if len(qa['question'].split()) <= 2:
@@ -285,146 +522,241 @@ class Data:
       self.question_to_paragraph[qa['id']] = len(self.paragraphs)
       self.questions[qa['id']] = qa['question']
       self.answers[qa['id']] = qa['answers']
+      qids.append(qa['id'])
 
     self.paragraphs.append(para_text)
-
-  def read_from_file(self, filename, max_articles):
-    dev_data = {}
-    with open(filename, 'r') as input_file:
-      data = json.load(input_file)
-      dev_data['version'] = data['version']
-      dev_data['data'] = []
-
-      data = data['data']
-      # Read each input article
-      for article_index, article in enumerate(data):
+    return qids
+
+  # Read paragraphs from the given file, yielding chunks of paragraphs as
+  # tuples of (index of first paragraph, number of paragraphs, question ids).
+  def read_paragraph_chunks(self, filename, max_articles):
+    chunk_start, chunk_qids = 0, []
+    articles = iter_in_background(iter_squad_articles(filename),
+                                  max_queued_articles)
+    try:
+      for article_index, article in enumerate(articles):
         if article_index == max_articles:
           break
-        dev_data['data'].append(article)
         # Read each para for each article
-        for para_index, paragraph in enumerate(article['paragraphs']):
-          self.add_paragraph(paragraph)
-          print "\r%d Articles, %d Paragraphs processed." \
-                  % (article_index+1, para_index+1),
-          sys.stdout.flush()
-      print ""
-
-    print "Tokenizing paragraphs (%d total)..." % len(self.paragraphs)
-    _, self.tokenized_para_words, self.paras_pos_tags, self.paras_ner_tags = \
-      zip(*Parallel(n_jobs=-1, verbose=2)(
-        delayed(tokenize_and_tag)(None, para_text) for para_text in self.paragraphs))
-    self.tokenized_para_words = list(self.tokenized_para_words)
-    for tokenized_para_words in tqdm(self.tokenized_para_words):
+        for paragraph in article['paragraphs']:
+          chunk_qids.extend(self.add_paragraph(paragraph))
+        if len(self.paragraphs) - chunk_start >= paragraph_chunk_size:
+          yield chunk_start, len(self.paragraphs) - chunk_start, chunk_qids
+          chunk_start, chunk_qids = len(self.paragraphs), []
+    finally:
+      # Stop reading articles ahead, if stopped early.
+      articles.close()
+    if len(self.paragraphs) > chunk_start:
+      yield chunk_start, len(self.paragraphs) - chunk_start, chunk_qids
+
+  # Convert annotations of a chunk of paragraphs and their questions to ids,
+  # and create data tuples for the chunk's questions.
+  def add_annotated_chunk(self, chunk, annotations):
+    chunk_start, num_paragraphs, qids = chunk
+    para_annotations, question_annotations = annotations
+
+    for tokenized_para_words, pos_tagged_para, ner_tagged_para, char_offsets in \
+          zip(*para_annotations):
+      self.tokenized_para_words.append(tokenized_para_words)
+      self.paras_char_offsets.append(char_offsets)
       if tokenized_para_words is None:
         self.tokenized_paras.append(None)
+        self.paras_pos_tags.append(None)
+        self.paras_ner_tags.append(None)
         continue
       self.tokenized_paras.append(self.get_ids(tokenized_para_words))
-    self.paras_pos_tags = list(self.paras_pos_tags)
-    for sent_id, pos_tagged_para in tqdm(enumerate(self.paras_pos_tags)):
-      if pos_tagged_para is None:
-        continue
-      assert len(pos_tagged_para) == len(self.tokenized_paras[sent_id]), str(sent_id)
-      self.paras_pos_tags[sent_id] = \
-        [ self.dictionary.add_or_get_postag(tag) for tag in pos_tagged_para ]
-    self.paras_ner_tags = list(self.paras_ner_tags)
-    for sent_id, ner_tagged_para in tqdm(enumerate(self.paras_ner_tags)):
-      if ner_tagged_para is None:
+      para_id = len(self.tokenized_paras) - 1
+      assert len(pos_tagged_para) == len(self.tokenized_paras[-1]), str(para_id)
+      self.paras_pos_tags.append(
+        [ self.dictionary.add_or_get_postag(tag) for tag in pos_tagged_para ])
+      assert len(ner_tagged_para) == len(self.tokenized_paras[-1]), str(para_id)
+      self.paras_ner_tags.append(
+        [ self.dictionary.add_or_get_nertag(tag) for tag in ner_tagged_para ])
+
+    for qid, tokenized_words, pos_tags, ner_tags, _ in \
+          zip(qids, *question_annotations):
+      self.questions_tokenized_words[qid] = tokenized_words
+      self.question_pos_tags[qid] = pos_tags
+      self.question_ner_tags[qid] = ner_tags
+      if tokenized_words is None:
         continue
-      assert len(ner_tagged_para) == len(self.tokenized_paras[sent_id]), str(sent_id)
-      self.paras_ner_tags[sent_id] = \
-        [ self.dictionary.add_or_get_nertag(tag) for tag in ner_tagged_para ]
-    print "Done!"
-
-    print "Tokenizing questions (%d total)..." % len(self.questions)
-    qids, self.questions_tokenized_words, self.question_pos_tags, self.question_ner_tags  = \
-      zip(*Parallel(n_jobs=-1, verbose=10)(
-        delayed(tokenize_and_tag)(qid, self.questions[qid]) for qid in self.questions))
-    self.questions_tokenized_words = dict(zip(qids, self.questions_tokenized_words))
-    self.question_pos_tags = dict(zip(qids, self.question_pos_tags))
-    self.question_ner_tags = dict(zip(qids, self.question_ner_tags))
-    for qid in tqdm(self.questions):
-      if self.questions_tokenized_words[qid] is None:
-        continue
-      self.questions_tokenized[qid] = self.get_ids(self.questions_tokenized_words[qid])
-    for qid in tqdm(self.question_pos_tags):
-      if self.question_pos_tags[qid] is None:
-        continue
-      assert len(self.question_pos_tags[qid]) == len(self.questions_tokenized_words[qid]),\
-             str(qid)
+      self.questions_tokenized[qid] = self.get_ids(tokenized_words)
+      assert len(pos_tags) == len(tokenized_words), str(qid)
       self.question_pos_tags[qid] = \
-        [ self.dictionary.add_or_get_postag(tag) for tag in self.question_pos_tags[qid] ]
-    for qid in tqdm(self.question_ner_tags):
-      if self.question_ner_tags[qid] is None:
-        continue
-      assert len(self.question_ner_tags[qid]) == len(self.question_pos_tags[qid]),\
-             str(qid)
+        [ self.dictionary.add_or_get_postag(tag) for tag in pos_tags ]
+      assert len(ner_tags) == len(pos_tags), str(qid)
       self.question_ner_tags[qid] = \
-        [ self.dictionary.add_or_get_nertag(tag) for tag in self.question_ner_tags[qid] ]
-    print "Done!"
+        [ self.dictionary.add_or_get_nertag(tag) for tag in ner_tags ]
 
-    to_process = (sum([ len(self.answers[qid]) for qid in self.questions ]))
-    print "Creating data tuples for input (%d total)..." % to_process
     qtop = self.question_to_paragraph
-    data, missed = \
-      zip(*Parallel(n_jobs=-1, verbose=10, batch_size=10000)\
-             (delayed(create_data)(qid, self.paragraphs[qtop[qid]],
-                                   self.tokenized_paras[qtop[qid]],
-                                   self.tokenized_para_words[qtop[qid]],
-                                   self.questions_tokenized[qid], self.dictionary,
-                                   self.questions[qid], self.answers[qid]) \
-                for qid in self.questions_tokenized))
-    self.data = [ item for sublist in data for item in sublist ]
-    self.missed = sum(missed)
-    print "Done!"
-
-    return dev_data
-
-# Pad a given sequence upto length "length" with the given "element".
-def pad(seq, element, length):
-  assert len(seq) <= length
-  padded_seq = seq + [element] * (length - len(seq))
-  assert len(padded_seq) == length
-  return padded_seq
-
-# Create a 2D numpy array of shape "length"x"length" with the given values set,
-# and rest set to element.
-def create2d(partial_matrix, element, length, ans_start):
-  padded_mat = numpy.zeros((length, length))
-  padded_mat[:partial_matrix.shape[0], ans_start:ans_start+partial_matrix.shape[1]] = partial_matrix
-  return padded_mat
+    for qid in qids:
+      if not qid in self.questions_tokenized:
+        continue
+      # Questions on paragraphs that failed to be annotated are missed.
+      if self.tokenized_paras[qtop[qid]] is None:
+        self.missed += len(self.answers[qid])
+        continue
+      data, missed = create_data(qid, self.paragraphs[qtop[qid]],
+                                 self.tokenized_paras[qtop[qid]],
+                                 self.tokenized_para_words[qtop[qid]],
+                                 self.paras_char_offsets[qtop[qid]],
+                                 self.questions_tokenized[qid],
+                                 self.questions[qid], self.answers[qid])
+      self.data.extend(data)
+      self.missed += missed
+
+  # Read, annotate and process data from a SQuAD json file as a pipeline:
+  # articles are parsed in a background thread, and each chunk of paragraphs
+  # is annotated (paragraphs, then their questions) by a worker thread, while
+  # annotated chunks are converted to data tuples in order, in this thread.
+  def read_from_file(self, filename, max_articles):
+    print "Reading, annotating and processing data..."
+    # Create the client before the workers share it.
+    get_corenlp_client(tag_annotators)
+    pool = ThreadPool(max_chunks_in_flight)
+    in_flight = collections.deque()
+    counts = { 'paragraphs': 0, 'questions': 0 }
+    def process_oldest_chunk():
+      chunk, annotations = in_flight.popleft()
+      self.add_annotated_chunk(chunk, annotations.get())
+      counts['paragraphs'] += chunk[1]
+      counts['questions'] += len(chunk[2])
+      print "\r%d Paragraphs, %d Questions processed." % \
+            (counts['paragraphs'], counts['questions']),
+      sys.stdout.flush()
 
-# Create a one-hot vector of the given size, with position 'pos' set to 1.
-def one_hot(pos, size):
-  return [ 1 if i == pos else 0 for i in range(size) ]
+    try:
+      for chunk in self.read_paragraph_chunks(filename, max_articles):
+        chunk_start, num_paragraphs, qids = chunk
+        paragraphs = self.paragraphs[chunk_start:chunk_start + num_paragraphs]
+        questions = [ self.questions[qid] for qid in qids ]
+        in_flight.append((chunk, pool.apply_async(annotate_chunk,
+                                                  (paragraphs, questions))))
+        # Process annotated chunks in order, waiting for the oldest chunk once
+        # the maximum number of chunks are in flight.
+        while len(in_flight) >= max_chunks_in_flight or \
+              (len(in_flight) > 0 and in_flight[0][1].ready()):
+          process_oldest_chunk()
+      while len(in_flight) > 0:
+        process_oldest_chunk()
+    finally:
+      pool.close()
+      pool.join()
+    print ""
+    print_corenlp_stats()
+    print "Done!"
 
-# Read train and dev data, either from json files or from pickles, and dump them in
-# pickles if necessary.
+# Flatten a list of sequences (or None) into a single numpy array of the
+# given item shape, along with the offsets of each sequence within it.
+def ragged_to_arrays(rows, item_shape=(), dtype=numpy.int32):
+  lengths = [ 0 if row is None else len(row) for row in rows ]
+  offsets = numpy.zeros(len(rows) + 1, dtype=numpy.int64)
+  offsets[1:] = numpy.cumsum(lengths)
+  values = numpy.zeros((offsets[-1],) + item_shape, dtype=dtype)
+  for row, start, end in zip(rows, offsets[:-1], offsets[1:]):
+    if end > start:
+      values[start:end] = row
+  return values, offsets
+
+class RaggedArray:
+  ''' Sequences of varying lengths, stored as slices of one flat array.
+      Items are looked up by position, or by key if keys are provided.'''
+
+  def __init__(self, values, offsets, keys=None):
+    self.values = values
+    self.offsets = offsets
+    self.key_to_row = None
+    if keys is not None:
+      self.key_to_row = dict(zip(keys, range(len(keys))))
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, key):
+    row = key if self.key_to_row is None else self.key_to_row[key]
+    return self.values[self.offsets[row]:self.offsets[row + 1]]
+
+  def lengths(self):
+    return numpy.diff(self.offsets)
+
+# Get a numpy array with the length of each of the given sequences, with 0 for
+# missing (None) sequences, such as paragraphs whose annotation failed.
+def sequence_lengths(seqs):
+  if isinstance(seqs, RaggedArray):
+    return seqs.lengths()
+  return numpy.fromiter((0 if seq is None else len(seq) for seq in seqs),
+                        dtype=numpy.int64, count=len(seqs))
+
+# Get (position, batch index) coordinates of all items in the given batch of
+# sequences, along with the concatenated items.
+def batch_coordinates(seqs):
+  lens = [ len(seq) for seq in seqs ]
+  positions = numpy.concatenate([ numpy.arange(seq_len) for seq_len in lens ])
+  batch_idxs = numpy.repeat(numpy.arange(len(seqs)), lens)
+  items = numpy.concatenate([ numpy.asarray(seq, dtype=numpy.int64) \
+                                for seq in seqs ])
+  return positions, batch_idxs, items
+
+# Create a numpy array of shape (length, batch) from the given sequences, padded
+# with zeros.
+def pad_batch(seqs, length, dtype=numpy.int64):
+  padded = numpy.zeros((length, len(seqs)), dtype=dtype)
+  positions, batch_idxs, items = batch_coordinates(seqs)
+  padded[positions, batch_idxs] = items
+  return padded
+
+# Create a float32 numpy array of shape (length, batch, size) with one-hot
+# vectors of the given sequences of ids, and zero vectors for padding.
+def one_hot_batch(seqs, length, size):
+  one_hot = numpy.zeros((length, len(seqs), size), dtype=numpy.float32)
+  positions, batch_idxs, items = batch_coordinates(seqs)
+  one_hot[positions, batch_idxs, items] = 1
+  return one_hot
+
+# Create a float32 numpy array of shape (batch, length, length) with the F1
+# scores of all candidate ranges against the true range of each answer, for
+# paragraphs of the given lengths. Ranges outside the paragraph are set to 0.
+def create_f1_matrices(answers, para_lens, length):
+  f1_matrices = numpy.zeros((len(answers), length, length), dtype=numpy.float32)
+  for idx, ((ans_start_idx, ans_end_idx), para_len) in \
+        enumerate(zip(answers, para_lens)):
+    f1_matrices[idx, :ans_end_idx+1, ans_start_idx:para_len] = \
+      f1_matrix(ans_start_idx, ans_end_idx, para_len)
+  return f1_matrices
+
+# Read train and dev data, either from json files or from dumped arrays, and
+# dump them as arrays if necessary.
 def read_data(train_json, train_pickle, dev_json, dev_pickle, max_train_articles,
-              max_dev_articles, dump_pickles):
+              max_dev_articles, dump_pickles, annotation_cache_path=None,
+              annotation_cache_mb=1024, corenlp_requests=8):
+  global corenlp_pool_size
   reload(sys)
   sys.setdefaultencoding('utf-8')
+  corenlp_pool_size = corenlp_requests
+  if annotation_cache_path:
+    set_annotation_cache(annotation_cache_path, annotation_cache_mb)
   train_data = Data()
   print "Reading training data."
   if train_json:
     train_data.read_from_file(train_json, max_train_articles)
   else:
-    train_data = train_data.read_from_pickle(train_pickle)
+    train_data = train_data.read_from_arrays(train_pickle)
 
   dev_data = Data(train_data.dictionary)
   if dev_json:
     print "Reading dev data."
-    dev_json_data = dev_data.read_from_file(dev_json, max_dev_articles)
+    dev_data.read_from_file(dev_json, max_dev_articles)
   else:
     print "Reading dev data."
-    dev_data = dev_data.read_from_pickle(dev_pickle)
+    dev_data = dev_data.read_from_arrays(dev_pickle)
     print "Done."
 
   if dump_pickles:
     assert not train_pickle == None
     assert not dev_pickle == None
-    print "Dumping pickles."
-    train_data.dump_pickle(train_pickle)
-    dev_data.dump_pickle(dev_pickle)
+    print "Dumping arrays."
+    train_data.dump_arrays(train_pickle)
+    dev_data.dump_arrays(dev_pickle)
     print "Done."
 
   print "Finished reading all required data."
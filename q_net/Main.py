@@ -1,21 +1,25 @@
 #!/usr/bin/env python
 
 import argparse
+import collections
 import cPickle as pickle
+import itertools
 import json
 import numpy as np
 import os
-import random
 import sys
 import time
 import torch
 import torch.nn as nn
 
+from multiprocessing.pool import ThreadPool
 from operator import itemgetter
 from torch.autograd import Variable
 from torch.optim import SGD, Adamax
-from Input import Dictionary, Data, pad, read_data, create2d, one_hot
-from qNet import qNet
+from Input import Dictionary, Data, read_data, create_f1_matrices, pad_batch,\
+                  one_hot_batch, sequence_lengths
+from qNet import qNet, scalar
+from Sampler import BucketSampler
 
 def init_parser():
   parser = argparse.ArgumentParser()
@@ -26,15 +30,34 @@ def init_parser():
   parser.add_argument('--dev_json',
                       help = "Path to the input dev json file containing SQuAD dev data.")
   parser.add_argument('--train_pickle',
-                      help = "Path to read/dump train pickle file to.")
+                      help = "Path to the directory to read/dump memory-mapped train data arrays "\
+                             "to.")
   parser.add_argument('--dev_pickle',
-                      help = "Path to read/dump dev pickle file to.")
+                      help = "Path to the directory to read/dump memory-mapped dev data arrays to.")
   parser.add_argument('--predictions_output_json',
                       help = "When using run_type test, output predictions will be written to this "\
                              "json")
+  parser.add_argument('--nbest_output',
+                      help = "When using run_type test, the top n_best answer spans of each question "\
+                             "are written to this json-lines file, with their scores and character "\
+                             "offsets in the paragraph.")
+  parser.add_argument('--n_best', type=int, default=5,
+                      help = "Number of answer spans per question written to nbest_output.")
+  parser.add_argument('--dump_distributions', action='store_true',
+                      help = "When using run_type test, also pickle the full answer start and end "\
+                             "distributions of each question next to predictions_output_json.")
   parser.add_argument('--dump_pickles', action='store_true',
-                      help = "Whether the train/dev pickles must be dumped. Input jsons must be "\
-                             "provided to create these pickles.")
+                      help = "Whether the train/dev data arrays must be dumped. Input jsons must be "\
+                             "provided to create these arrays.")
+  parser.add_argument('--annotation_cache',
+                      help = "Path to an SQLite file caching CoreNLP annotations of paragraphs and "\
+                             "questions across runs, when reading from json files.")
+  parser.add_argument('--annotation_cache_mb', type=int, default=1024,
+                      help = "Maximum size of the annotation cache in MB. Least recently used "\
+                             "annotations are evicted beyond this size.")
+  parser.add_argument('--corenlp_requests', type=int, default=8,
+                      help = "Maximum number of concurrent annotation requests to the CoreNLP server, "\
+                             "when reading from json files.")
   parser.add_argument('--max_train_articles', type=int, default=-1,
                       help = "Maximum number of training articles to use, while reading from the "\
                              "train json file.")
@@ -58,10 +81,15 @@ def init_parser():
   parser.add_argument('--loss_increase_epochs', type=int, default=2,
                       help = "Stop training if dev loss has increased continuously for these many epochs.")
   parser.add_argument('--vectors_path', default='../../data/fasttext/crawl-300d-2M.vec',
-                      help = "Path to the pre-trained vectors to use for the embedding layer.")
+                      help = "Path to the pre-trained vectors to use for the embedding layer. Either a "\
+                             "text vectors file, or the .npy matrix of a vector store converted from "\
+                             "one with Embeddings.py, which loads much faster.")
   parser.add_argument('--disable_pretrained', action='store_true',
                       help = "When provided, pretrained vectors are not used, and an embedding layer is "\
                              "learned in an end-to-end manner.")
+  parser.add_argument('--half_embeddings', action='store_true',
+                      help = "With cuda, store the (fixed) pre-trained embeddings as float16 on the GPU, "\
+                             "halving their memory.")
   parser.add_argument('--ckpt', type=int, default=0,
                       help = "Checkpoint number to resume from. If 0, starts training from scratch.")
   parser.add_argument('--model_file',
@@ -74,8 +102,24 @@ def init_parser():
                              "dev predictions json files after every epoch.")
   parser.add_argument('--batch_size', type=int, default=32,
                       help = "Batch size to use during training.")
+  parser.add_argument('--bucket_size', type=int, default=50,
+                      help = "Number of batches per bucket of training examples of similar lengths. "\
+                             "Examples are shuffled within buckets, and batches across buckets, "\
+                             "every epoch.")
+  parser.add_argument('--batch_tokens', type=int, default=0,
+                      help = "If > 0, batches are sized by a budget of (batch size x longest passage "\
+                             "length) tokens instead of by batch_size and test_batch_size.")
+  parser.add_argument('--batch_f1_cells', type=int, default=0,
+                      help = "If > 0 and the F1 loss is used, batches are additionally limited to "\
+                             "(batch size x longest passage length ^ 2) F1 matrix cells.")
   parser.add_argument('--test_batch_size', type=int, default=32,
                       help = "Batch size to use during development and test data passes.")
+  parser.add_argument('--num_workers', type=int, default=1,
+                      help = "Number of background threads building upcoming batches while the "\
+                             "current batch is run. If 0, batches are built synchronously.")
+  parser.add_argument('--prefetch', type=int, default=4,
+                      help = "Maximum number of batches built ahead of the current batch, when "\
+                             "num_workers > 0.")
   parser.add_argument('--optimizer', default='Adamax',
                       help = "Optimizer to use. One of either 'SGD', 'Adamax' or 'Adadelta'.")
   parser.add_argument('--debug_level', type=int, default=0,
@@ -98,6 +142,25 @@ def init_parser():
                       help = "Number of MatchLSTM layers to use.")
   parser.add_argument('--num_selfmatch_layers', type=int, default=0,
                       help = "Number of passage self-matching layers to use.")
+  parser.add_argument('--match_layer_type', default='recurrent',
+                      choices=['recurrent', 'precomputed'],
+                      help = "Question-passage match layers to use. 'recurrent' match LSTMs attend "\
+                             "to the question given the previous hidden state at each step, as in "\
+                             "Wang & Jiang. 'precomputed' layers compute the question attention for "\
+                             "all passage positions at once, without the hidden state, and run a "\
+                             "standard bi-directional LSTM over the result, which is much faster.")
+  parser.add_argument('--selfmatch_window', type=int, default=0,
+                      help = "If > 0, self-matching layers attend only to passage positions within "\
+                             "this distance of each position, and to selfmatch_global passage "\
+                             "summaries, making their cost linear in the passage length. If 0, they "\
+                             "attend to the whole passage.")
+  parser.add_argument('--selfmatch_global', type=int, default=4,
+                      help = "Number of passage summaries (means of equal passage segments) attended "\
+                             "to by windowed self-matching layers.")
+  parser.add_argument('--compile_match', action='store_true',
+                      help = "Compile the recurrences of the match LSTM and self-matching layers with "\
+                             "TorchScript (requires PyTorch >= 1.0), instead of running each step "\
+                             "from Python.")
   parser.add_argument('--f1_loss_multiplier', type=float, default=0.0,
                       help = "Multiply the Expected F1 loss by this value. Useful as this loss has a "\
                              "smaller magnitude than the MLE loss.")
@@ -112,6 +175,15 @@ def init_parser():
 
 
 #------------- ---------------- Preprocess data -------------------------------#
+# Get the passage and question lengths of the given examples.
+# Data format = (tokenized_question, answer span, question_id, answer sentence).
+def example_lengths(examples, ques_to_para, tokenized_paras):
+  para_lengths = sequence_lengths(tokenized_paras)
+  passage_lengths = para_lengths[[ ques_to_para[example[2]] \
+                                     for example in examples ]]
+  question_lengths = sequence_lengths([ example[0] for example in examples ])
+  return passage_lengths, question_lengths
+
 def read_and_process_data(args):
   assert not (args.train_json == None and args.train_pickle == None)
   assert not (args.dev_json == None and args.dev_pickle == None)
@@ -119,7 +191,8 @@ def read_and_process_data(args):
   #----------------------- Read train, dev and test data ------------------------#
   train_data, dev_data = \
     read_data(args.train_json, args.train_pickle, args.dev_json, args.dev_pickle,
-              args.max_train_articles, args.max_dev_articles, args.dump_pickles)
+              args.max_train_articles, args.max_dev_articles, args.dump_pickles,
+              args.annotation_cache, args.annotation_cache_mb, args.corenlp_requests)
   #------------------------------------------------------------------------------#
 
   # Our dev is also test...
@@ -137,37 +210,42 @@ def read_and_process_data(args):
   dev_tokenized_paras = dev_data.tokenized_paras
   test_tokenized_paras = dev_data.tokenized_paras
 
-  # Sort data by increasing passage+question, for efficient batching.
-  # Data format = (tokenized_question, tokenized_answer, question_id).
-  print "Sorting datasets in decreasing order of (para + question) lengths."
-  train.sort(cmp=lambda x,y:\
-      len(x[0]) + len(train_tokenized_paras[train_ques_to_para[x[2]]]) -\
-      (len(y[0]) + len(train_tokenized_paras[train_ques_to_para[y[2]]])),
-      reverse=True)
-  dev.sort(cmp=lambda x,y:\
-      len(x[0]) + len(dev_tokenized_paras[dev_ques_to_para[x[2]]]) -\
-      (len(y[0]) + len(dev_tokenized_paras[dev_ques_to_para[y[2]]])),
-      reverse=True)
-  test.sort(cmp=lambda x,y:\
-      len(x[0]) + len(test_tokenized_paras[test_ques_to_para[x[2]]]) -\
-      (len(y[0]) + len(test_tokenized_paras[test_ques_to_para[y[2]]])),
-      reverse=True)
-  print "Done."
-
-  # Debug flag reduces size of input data, for testing purposes.
+  # Debug flag reduces size of input data to its longest examples, for testing
+  # purposes.
   if args.debug_level > 0:
-    train = train[:320]
-    dev = dev[:320]
-    test = test[:320]
-
-  train_order = [ i for i in range(0, len(train), batch_size) ]
-  dev_order = [ i for i in range(0, len(dev), test_batch_size) ]
-  test_order = [ i for i in range(0, len(test), test_batch_size) ]
+    def longest(examples, ques_to_para, tokenized_paras):
+      passage_lengths, question_lengths = \
+        example_lengths(examples, ques_to_para, tokenized_paras)
+      lengths = passage_lengths + question_lengths
+      return [ examples[idx] \
+                 for idx in np.argsort(-lengths, kind='mergesort')[:320] ]
+    train = longest(train, train_ques_to_para, train_tokenized_paras)
+    dev = longest(dev, dev_ques_to_para, dev_tokenized_paras)
+    test = dev
+
+  # Batches are formed from buckets of examples of similar (passage + question)
+  # lengths, and optionally sized by token budgets over passage lengths, as the
+  # matching layers iterate over the longest passage in the batch. Batches are
+  # lists of indices into the (unsorted) examples.
+  print "Batching datasets by decreasing (para + question) lengths."
+  max_f1_cells = args.batch_f1_cells if args.f1_loss_multiplier > 0 else 0
+  def make_sampler(examples, ques_to_para, tokenized_paras, size, shuffle):
+    passage_lengths, question_lengths = \
+      example_lengths(examples, ques_to_para, tokenized_paras)
+    return BucketSampler(passage_lengths + question_lengths, size,
+                         args.bucket_size, shuffle, passage_lengths,
+                         args.batch_tokens, max_f1_cells)
+  train_sampler = make_sampler(train, train_ques_to_para, train_tokenized_paras,
+                               batch_size, True)
+  dev_order = make_sampler(dev, dev_ques_to_para, dev_tokenized_paras,
+                           test_batch_size, False).batches()
+  # Test is the same as dev, and shares its batches.
+  test_order = dev_order
   print "Done."
 
   return train, dev, test, batch_size, test_batch_size, train_ques_to_para,\
          dev_ques_to_para, test_ques_to_para, train_tokenized_paras,\
-         dev_tokenized_paras, test_tokenized_paras, train_order, dev_order,\
+         dev_tokenized_paras, test_tokenized_paras, train_sampler, dev_order,\
          test_order, train_data, dev_data, test_data
 #------------------------------------------------------------------------------#
 
@@ -184,6 +262,7 @@ def build_model(args, vocab_size, index_to_word, word_to_index, num_pos_tags,
              'dropout' : args.dropout,
              'vectors_path' : args.vectors_path,
              'use_pretrained' : not args.disable_pretrained,
+             'half_embeddings' : args.half_embeddings,
              'ckpt': args.ckpt,
              'optimizer': args.optimizer,
              'index_to_word': index_to_word,
@@ -196,7 +275,11 @@ def build_model(args, vocab_size, index_to_word, word_to_index, num_pos_tags,
              'num_preprocessing_layers': args.num_preprocessing_layers,
              'num_postprocessing_layers': args.num_postprocessing_layers,
              'num_matchlstm_layers': args.num_matchlstm_layers,
-             'num_selfmatch_layers': args.num_selfmatch_layers }
+             'num_selfmatch_layers': args.num_selfmatch_layers,
+             'match_layer_type': args.match_layer_type,
+             'compile_match': args.compile_match,
+             'selfmatch_window': args.selfmatch_window,
+             'selfmatch_global': args.selfmatch_global }
   print "Building model."
   model = qNet(config, args.debug_level)
   print "Done!"
@@ -207,7 +290,7 @@ def build_model(args, vocab_size, index_to_word, word_to_index, num_pos_tags,
   print model.oov_list[:10]
 
   if not args.disable_pretrained:
-    print "Embedding dim:", model.embedding.shape
+    print "Embedding dim:", tuple(model.embedding.weight.size())
   print "POS tags (%d total):" % (num_pos_tags), pos_tags
   print "NER tags (%d total):" % (num_ner_tags), ner_tags
 
@@ -219,7 +302,8 @@ def build_model(args, vocab_size, index_to_word, word_to_index, num_pos_tags,
 
 #--------------------------- Create an input minibatch ------------------------#
 def get_batch(batch, ques_to_para, tokenized_paras, paras_pos_tags, paras_ner_tags,
-              question_pos_tags, question_ner_tags, num_pos_tags, num_ner_tags):
+              question_pos_tags, question_ner_tags, num_pos_tags, num_ner_tags,
+              with_f1_matrices):
   # Variable length question, answer and paragraph sequences for batch.
   ques_lens_in = [ len(example[0]) for example in batch ]
   paras_in = [ tokenized_paras[ques_to_para[example[2]]] \
@@ -238,41 +322,23 @@ def get_batch(batch, ques_to_para, tokenized_paras, paras_pos_tags, paras_ner_ta
 
   # ans_in.shape = (2, batch)
   ans_in = np.array([ example[1] for example in batch ]).T
-  sent_in = np.array([ example[4] for example in batch ]).T
+  sent_in = np.array([ example[3] for example in batch ]).T
 
-  # f1_mat_in.shape = (batch, seq_len, seq_len)
-  f1_mat_in = np.array([ create2d(example[3], 0, max_para_len, example[1][0]) \
-                           for example in batch])
+  # f1_mat_in.shape = (batch, seq_len, seq_len), only needed for the F1 loss.
+  f1_mat_in = None
+  if with_f1_matrices:
+    f1_mat_in = create_f1_matrices([ example[1] for example in batch ],
+                                   paras_lens_in, max_para_len)
   # Fixed-length (padded) input sequences with shape=(seq_len, batch).
-  ques_in = np.array([ pad(example[0], 0, max_ques_len)\
-                         for example in batch ]).T
-  paras_in = np.array([ pad(para, 0, max_para_len) for para in paras_in ]).T
-
-  # Fixed-length (padded) pos-tag and ner-tag inputs.
-  question_pos_tags = \
-    np.array([ pad([ one_hot(postag, num_pos_tags) for postag in ques_pos_tags ],
-                   one_hot(-1, num_pos_tags),
-                   max_ques_len) \
-                 for ques_pos_tags in ques_pos_tags_in ])
-  question_ner_tags = \
-    np.array([ pad([ one_hot(nertag, num_ner_tags) for nertag in ques_ner_tags ],
-                   one_hot(-1, num_ner_tags),
-                   max_ques_len) \
-                 for ques_ner_tags in ques_ner_tags_in ])
-  paragraph_pos_tags = \
-    np.array([ pad([ one_hot(postag, num_pos_tags) for postag in paras_pos_tags ],
-                   one_hot(-1, num_pos_tags),
-                   max_para_len) \
-                 for paras_pos_tags in paras_pos_tags_in ])
-  paragraph_ner_tags = \
-    np.array([ pad([ one_hot(nertag, num_ner_tags) for nertag in paras_ner_tags ],
-                   one_hot(-1, num_ner_tags),
-                   max_para_len) \
-                 for paras_ner_tags in paras_ner_tags_in ])
-  question_pos_tags = np.transpose(question_pos_tags, (1, 0, 2))
-  question_ner_tags = np.transpose(question_ner_tags, (1, 0, 2))
-  paragraph_pos_tags = np.transpose(paragraph_pos_tags, (1, 0, 2))
-  paragraph_ner_tags = np.transpose(paragraph_ner_tags, (1, 0, 2))
+  ques_in = pad_batch([ example[0] for example in batch ], max_ques_len)
+  paras_in = pad_batch(paras_in, max_para_len)
+
+  # Fixed-length (padded) one-hot pos-tag and ner-tag inputs, with
+  # shape=(seq_len, batch, num_tags).
+  question_pos_tags = one_hot_batch(ques_pos_tags_in, max_ques_len, num_pos_tags)
+  question_ner_tags = one_hot_batch(ques_ner_tags_in, max_ques_len, num_ner_tags)
+  paragraph_pos_tags = one_hot_batch(paras_pos_tags_in, max_para_len, num_pos_tags)
+  paragraph_ner_tags = one_hot_batch(paras_ner_tags_in, max_para_len, num_ner_tags)
 
   passage_input = (paras_in, paras_lens_in)
   question_input = (ques_in, ques_lens_in)
@@ -285,13 +351,54 @@ def get_batch(batch, ques_to_para, tokenized_paras, paras_pos_tags, paras_ner_ta
 #------------------------------------------------------------------------------#
 
 
-#--------------- Get the answers from predicted distributions------------------#
-def get_batch_answers(args, batch, all_predictions, distributions, data):
-  # Get numpy arrays out of the CUDA tensors.
-  for j in range(len(distributions)):
-    for k in range(len(distributions[j])):
-      distributions[j][k] = distributions[j][k].data.cpu().numpy()
+#------------------------ Prefetch upcoming minibatches -----------------------#
+class BatchPrefetcher:
+  ''' Builds batches with num_workers background threads, staying up to
+      prefetch batches ahead of the consumer. Keeps track of the time the
+      consumer spends waiting for batches.'''
+
+  def __init__(self, make_batch, num_workers, prefetch):
+    self.make_batch = make_batch
+    self.num_workers = num_workers
+    self.prefetch = max(prefetch, 1)
+    self.wait_time = 0.0
+
+  # Yield (input, batch) for each of the given batch inputs, in order.
+  def iterate(self, inputs):
+    self.wait_time = 0.0
+    if self.num_workers == 0:
+      for inp in inputs:
+        start_t = time.time()
+        batch = self.make_batch(inp)
+        self.wait_time += time.time() - start_t
+        yield inp, batch
+      return
+
+    pool = ThreadPool(self.num_workers)
+    pending = collections.deque()
+    try:
+      inputs = iter(inputs)
+      for inp in itertools.islice(inputs, self.prefetch + 1):
+        pending.append((inp, pool.apply_async(self.make_batch, (inp,))))
+      while len(pending) > 0:
+        inp, batch = pending.popleft()
+        start_t = time.time()
+        batch = batch.get()
+        self.wait_time += time.time() - start_t
+        # Keep the queue full, before handing the batch over.
+        for inp_next in itertools.islice(inputs, 1):
+          pending.append((inp_next, pool.apply_async(self.make_batch, (inp_next,))))
+        yield inp, batch
+    finally:
+      pool.terminate()
+#------------------------------------------------------------------------------#
 
+
+#--------------- Get the answers from predicted distributions------------------#
+# Returns the qids, best answers, and top k (start, end, score) spans of the
+# examples in the batch.
+def get_batch_answers(args, model, batch, all_predictions, distributions, data,
+                      k=1):
   # Add all batch qids to predictions dict, if they don't already exist.
   qids = [ example[2] for example in batch ]
   for qid in qids:
@@ -300,27 +407,12 @@ def get_batch_answers(args, batch, all_predictions, distributions, data):
 
   tokenized_paras = data.tokenized_paras
   ques_to_para = data.question_to_paragraph
-  paras_in = [ tokenized_paras[ques_to_para[example[2]]] \
-                 for example in batch ]
-  paras_lens_in = [ len(para) for para in paras_in ]
+  paras_lens_in = [ len(tokenized_paras[ques_to_para[qid]]) for qid in qids ]
 
-  best_idxs = []
   # distributions => (forward/backward,start/end,batch,values). Phew!
-  for idx in range(len(batch)):
-    best_prob = -1
-    best = [0, 0]
-    max_end = paras_lens_in[idx]
-    for j, start_prob in enumerate(distributions[0][0][idx][:max_end]):
-      cur_end_idx = max_end if args.max_answer_span == -1 \
-                            else j + args.max_answer_span
-      end_idx = np.argmax(distributions[0][1][idx][j:cur_end_idx] * \
-                          distributions[1][0][idx][j:cur_end_idx])
-      prob = distributions[0][1][idx][j+end_idx] * start_prob * \
-             distributions[1][1][idx][j] * distributions[1][0][idx][j+end_idx]
-      if prob > best_prob:
-        best_prob = prob
-        best = [j, j+end_idx]
-    best_idxs.append(best)
+  spans = model.decode_spans(distributions, paras_lens_in, args.max_answer_span,
+                             k)
+  best_idxs = [ example_spans[0][:2] for example_spans in spans ]
 
   answers = [ tokenized_paras[ques_to_para[qids[idx]]][start:end+1] \
                 for idx, (start, end) in enumerate(best_idxs) ]
@@ -330,7 +422,28 @@ def get_batch_answers(args, batch, all_predictions, distributions, data):
   for qid, answer in zip(qids, answers):
     all_predictions[qid] = answer
 
-  return qids, answers
+  return qids, answers, spans
+
+# Write the top answer spans of each question not yet written to the given
+# json-lines file, with token and character offsets in the paragraph.
+def write_nbest(nbest_file, written_qids, qids, spans, data):
+  for qid, example_spans in zip(qids, spans):
+    if qid in written_qids:
+      continue
+    written_qids.add(qid)
+    para_idx = data.question_to_paragraph[qid]
+    tokenized_para = data.tokenized_paras[para_idx]
+    char_offsets = data.paras_char_offsets[para_idx]
+    nbest = []
+    for start, end, score in example_spans:
+      nbest.append({ 'text': " ".join([ data.dictionary.get_word(idx) \
+                                          for idx in tokenized_para[start:end+1] ]),
+                     'score': score,
+                     'start': start,
+                     'end': end,
+                     'char_start': int(char_offsets[start][0]),
+                     'char_end': int(char_offsets[end][1]) })
+    nbest_file.write(json.dumps({ 'id': qid, 'nbest': nbest }) + "\n")
 #------------------------------------------------------------------------------#
 
 
@@ -338,7 +451,7 @@ def train_model(args):
   # Read and process data
   train, dev, test, batch_size, test_batch_size, train_ques_to_para,\
   dev_ques_to_para, test_ques_to_para, train_tokenized_paras,\
-  dev_tokenized_paras, test_tokenized_paras, train_order, dev_order, test_order,\
+  dev_tokenized_paras, test_tokenized_paras, train_sampler, dev_order, test_order,\
   train_data, dev_data, test_data = read_and_process_data(args)
 
   # Build model
@@ -361,7 +474,7 @@ def train_model(args):
     model = model.load(args.model_dir, last_done_epoch)
     print "Loaded model."
     if not args.disable_pretrained:
-      print "Embedding shape:", model.embedding.shape
+      print "Embedding shape:", tuple(model.embedding.weight.size())
 
   if args.model_file is not None:
     model = model.load_from_file(args.model_file)
@@ -370,12 +483,14 @@ def train_model(args):
   start_time = time.time()
   print "Starting training."
 
+  # Fixed pre-trained embeddings aren't optimized.
+  trained_parameters = [ param for param in model.parameters() if param.requires_grad ]
   if args.optimizer == "SGD":
     print "Using SGD optimizer."
-    optimizer = SGD(model.parameters(), lr = args.learning_rate_start)
+    optimizer = SGD(trained_parameters, lr = args.learning_rate_start)
   elif args.optimizer == "Adamax":
     print "Using Adamax optimizer."
-    optimizer = Adamax(model.parameters(), lr = args.learning_rate_start)
+    optimizer = Adamax(trained_parameters, lr = args.learning_rate_start)
     if last_done_epoch > 0:
       if os.path.exists(args.model_dir + "/optim_%d.pt" % last_done_epoch):
         optimizer.load_state_dict(
@@ -386,6 +501,27 @@ def train_model(args):
     assert False, "Unrecognized optimizer."
   print(model)
 
+  # Batches are built in the background while the model runs.
+  train_batches = BatchPrefetcher(
+    lambda idxs: get_batch([ train[idx] for idx in idxs ], train_ques_to_para,
+                          train_tokenized_paras, train_data.paras_pos_tags,
+                          train_data.paras_ner_tags, train_data.question_pos_tags,
+                          train_data.question_ner_tags, num_pos_tags, num_ner_tags,
+                          args.f1_loss_multiplier > 0),
+    args.num_workers, args.prefetch)
+  dev_batches = BatchPrefetcher(
+    lambda idxs: get_batch([ dev[idx] for idx in idxs ], dev_ques_to_para,
+                          dev_tokenized_paras, dev_data.paras_pos_tags,
+                          dev_data.paras_ner_tags, dev_data.question_pos_tags,
+                          dev_data.question_ner_tags, num_pos_tags, num_ner_tags,
+                          args.f1_loss_multiplier > 0),
+    args.num_workers, args.prefetch)
+
+  # Passages and questions are padded separately, so report their padding
+  # separately.
+  train_passage_lengths, train_question_lengths = \
+    example_lengths(train, train_ques_to_para, train_tokenized_paras)
+
   print "Starting training loop."
   cur_learning_rate = args.learning_rate_start
   dev_loss_prev = float('inf')
@@ -394,41 +530,41 @@ def train_model(args):
     start_t = time.time()
     train_loss_sum = 0.0
     model.set_train()
-    for i, num in enumerate(train_order):
+    train_order = train_sampler.batches()
+    print "Epoch %d: %d batches, %.2f%% passage padding, %.2f%% question "\
+          "padding." % \
+          (EPOCH, len(train_order),
+           100 * train_sampler.padding_ratio(train_order, train_passage_lengths),
+           100 * train_sampler.padding_ratio(train_order, train_question_lengths))
+    for i, (_, train_input) in enumerate(train_batches.iterate(train_order)):
       print "\r[%.2f%%] Train epoch %d, %.2f s - (Done %d of %d)" %\
             ((100.0 * (i+1))/len(train_order), EPOCH,
              (time.time()-start_t)*(len(train_order)-i-1)/(i+1), i+1,
              len(train_order)),
 
-      # Create next batch by getting lengths and padding
-      train_batch = train[num:num+batch_size]
-
       # Zero previous gradient.
       model.zero_grad()
 
       # Predict on the network_id assigned to this minibatch.
-      model(*get_batch(train_batch, train_ques_to_para, train_tokenized_paras,
-                       train_data.paras_pos_tags, train_data.paras_ner_tags,
-                       train_data.question_pos_tags, train_data.question_ner_tags,
-                       num_pos_tags, num_ner_tags))
+      model(*train_input)
       model.loss.backward()
       optimizer.step()
-      train_loss_sum += model.loss.data[0]
+      train_loss_sum += scalar(model.loss)
 
       print "Loss Total: %.5f, Cur: %.5f (in time %.2fs) " % \
-            (train_loss_sum/(i+1), model.loss.data[0], time.time() - start_t),
+            (train_loss_sum/(i+1), scalar(model.loss), time.time() - start_t),
       if args.show_losses and args.f1_loss_multiplier > 0:
-        print "[MLE: %.5f, F1: %.5f]" % (model.mle_loss.data[0], model.f1_loss.data[0]),
+        print "[MLE: %.5f, F1: %.5f]" % (scalar(model.mle_loss), scalar(model.f1_loss)),
       sys.stdout.flush()
       if args.debug_level >= 3:
         print ""
       model.free_memory()
 
-    print "\nLoss: %.5f (in time %.2fs)" % \
-          (train_loss_sum/len(train_order), time.time() - start_t)
+    print "\nLoss: %.5f (in time %.2fs, data wait %.2fs)" % \
+          (train_loss_sum/len(train_order), time.time() - start_t,
+           train_batches.wait_time)
 
     # End of epoch.
-    random.shuffle(train_order)
     model.zero_grad()
     model.save(args.model_dir, EPOCH)
 
@@ -446,33 +582,30 @@ def train_model(args):
     print "\nRunning on Dev."
 
     model.set_eval()
-    for i, num in enumerate(dev_order):
+    for i, (idxs, dev_input) in enumerate(dev_batches.iterate(dev_order)):
       print "\rDev: %.2f s (Done %d of %d)" %\
             ((time.time()-dev_start_t)*(len(dev_order)-i-1)/(i+1), i+1,
             len(dev_order)),
 
-      dev_batch = dev[num:num+test_batch_size]
+      dev_batch = [ dev[idx] for idx in idxs ]
 
-      # distributions[{0,1}][{0,1}].shape = (batch, max_passage_len)
+      # Log distributions[{0,1}][{0,1}].shape = (batch, max_passage_len)
       # Predict using both networks.
-      distributions = \
-        model(*get_batch(dev_batch, dev_ques_to_para, dev_tokenized_paras,
-                         dev_data.paras_pos_tags, dev_data.paras_ner_tags,
-                         dev_data.question_pos_tags, dev_data.question_ner_tags,
-                         num_pos_tags, num_ner_tags))
+      distributions = model(*dev_input)
 
       # Add predictions to all answers.
-      get_batch_answers(args, dev_batch, all_predictions, distributions,
+      get_batch_answers(args, model, dev_batch, all_predictions, distributions,
                         dev_data)
 
-      dev_loss_sum += model.loss.data[0]
-      print "[Average loss : %.5f, Cur: %.5f]" % (dev_loss_sum/(i+1), model.loss.data[0]),
+      dev_loss_sum += scalar(model.loss)
+      print "[Average loss : %.5f, Cur: %.5f]" % (dev_loss_sum/(i+1), scalar(model.loss)),
       sys.stdout.flush()
       model.free_memory()
 
     # Print dev stats for epoch
-    print "\nDev Loss: %.4f (in time: %.2f s)" %\
-          (dev_loss_sum/len(dev_order), (time.time() - dev_start_t))
+    print "\nDev Loss: %.4f (in time: %.2f s, data wait %.2f s)" %\
+          (dev_loss_sum/len(dev_order), (time.time() - dev_start_t),
+           dev_batches.wait_time)
 
     # Dump the results json in the required format
     print "Dumping prediction results."
@@ -502,7 +635,7 @@ def test_model(args):
   # Read and process data
   train, dev, test, batch_size, test_batch_size, train_ques_to_para,\
   dev_ques_to_para, test_ques_to_para, train_tokenized_paras,\
-  dev_tokenized_paras, test_tokenized_paras, train_order, dev_order, test_order,\
+  dev_tokenized_paras, test_tokenized_paras, train_sampler, dev_order, test_order,\
   train_data, dev_data, test_data = read_and_process_data(args)
 
   # Build model
@@ -525,64 +658,84 @@ def test_model(args):
     model = model.load(args.model_dir, last_done_epoch)
     print "Loaded model."
     if not args.disable_pretrained:
-      print "Embedding shape:", model.embedding.shape
+      print "Embedding shape:", tuple(model.embedding.weight.size())
 
   test_start_t = time.time()
   test_loss_sum = 0.0
   all_predictions = {}
   attention_starts = {}
   attention_ends = {}
+  nbest_file = None
+  written_qids = set()
+  if args.nbest_output is not None:
+    nbest_file = open(args.nbest_output, "w")
   model.set_eval()
 
-  for i, num in enumerate(test_order):
+  # The loaded model computes the F1 loss if it was trained with it, whatever
+  # the command-line flags.
+  with_f1_matrices = model.f1_loss_multiplier > 0
+  test_batches = BatchPrefetcher(
+    lambda idxs: get_batch([ test[idx] for idx in idxs ], test_ques_to_para,
+                          test_tokenized_paras, test_data.paras_pos_tags,
+                          test_data.paras_ner_tags, test_data.question_pos_tags,
+                          test_data.question_ner_tags, num_pos_tags, num_ner_tags,
+                          with_f1_matrices),
+    args.num_workers, args.prefetch)
+  for i, (idxs, test_input) in enumerate(test_batches.iterate(test_order)):
     print "\rTest: %.2f s (Done %d of %d) " %\
           ((time.time()-test_start_t)*(len(test_order)-i-1)/(i+1), i+1,
           len(test_order)),
 
-    test_batch = test[num:num+test_batch_size]
+    test_batch = [ test[idx] for idx in idxs ]
     batch_size = len(test_batch)
 
-    # distributions[{0,1}].shape = (batch, max_passage_len)
-    distributions = \
-        model(*get_batch(test_batch, test_ques_to_para, test_tokenized_paras,
-                         test_data.paras_pos_tags, test_data.paras_ner_tags,
-                         test_data.question_pos_tags, test_data.question_ner_tags,
-                         num_pos_tags, num_ner_tags))
+    # Log distributions[{0,1}][{0,1}].shape = (batch, max_passage_len)
+    distributions = model(*test_input)
 
     # Add predictions to all answers.
-    get_batch_answers(args, test_batch, all_predictions, distributions, test_data)
+    qids, _, spans = \
+      get_batch_answers(args, model, test_batch, all_predictions, distributions,
+                        test_data, args.n_best if nbest_file is not None else 1)
+    if nbest_file is not None:
+      write_nbest(nbest_file, written_qids, qids, spans, test_data)
 
     # Dump start and end attention distributions from "0" id network.
-    ans_in = np.array([ example[1] for example in test_batch ]).T
-    qids = [ example[2] for example in test_batch ]
-    for idx in range(batch_size):
-      if qids[idx] in attention_starts:
-        attention_starts[qids[idx]][1].append(ans_in[0][idx])
-      else:
-        attention_starts[qids[idx]] = (distributions[0][0][idx], [ans_in[0][idx]])
-      if qids[idx] in attention_ends:
-        attention_ends[qids[idx]][1].append(ans_in[0][idx])
-      else:
-        attention_ends[qids[idx]] = (distributions[0][1][idx], [ans_in[1][idx]])
-
-    test_loss_sum += model.loss.data[0]
+    if args.dump_distributions:
+      start_distributions = np.exp(distributions[0][0].data.cpu().numpy())
+      end_distributions = np.exp(distributions[0][1].data.cpu().numpy())
+      ans_in = np.array([ example[1] for example in test_batch ]).T
+      for idx in range(batch_size):
+        if qids[idx] in attention_starts:
+          attention_starts[qids[idx]][1].append(ans_in[0][idx])
+        else:
+          attention_starts[qids[idx]] = (start_distributions[idx], [ans_in[0][idx]])
+        if qids[idx] in attention_ends:
+          attention_ends[qids[idx]][1].append(ans_in[0][idx])
+        else:
+          attention_ends[qids[idx]] = (end_distributions[idx], [ans_in[1][idx]])
+
+    test_loss_sum += scalar(model.loss)
     print "[Average loss : %.5f]" % (test_loss_sum/(i+1)),
     sys.stdout.flush()
     model.free_memory()
 
   # Print stats
-  print "\nTest Loss: %.4f (in time: %.2f s)" %\
-        (test_loss_sum/len(test_order), (time.time() - test_start_t))
+  print "\nTest Loss: %.4f (in time: %.2f s, data wait %.2f s)" %\
+        (test_loss_sum/len(test_order), (time.time() - test_start_t),
+         test_batches.wait_time)
 
   # Dump the results json in the required format
   print "Dumping prediction results."
   json.dump(all_predictions, open(args.predictions_output_json, "w"))
+  if nbest_file is not None:
+    nbest_file.close()
 
   # Dump attention start and end distributions.
-  pickle.dump(attention_starts,
-              open(args.predictions_output_json + "_starts.p", "wb"))
-  pickle.dump(attention_ends,
-              open(args.predictions_output_json + "_ends.p", "wb"))
+  if args.dump_distributions:
+    pickle.dump(attention_starts,
+                open(args.predictions_output_json + "_starts.p", "wb"))
+    pickle.dump(attention_ends,
+                open(args.predictions_output_json + "_ends.p", "wb"))
   print "Done."
 #------------------------------------------------------------------------------#
 
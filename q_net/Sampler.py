@@ -0,0 +1,77 @@
+import numpy as np
+import random
+
+class BucketSampler:
+  ''' Forms batches of examples of similar lengths. Examples are ordered by
+      decreasing length once, with argsort, and grouped into buckets of
+      bucket_size batches. Every epoch, examples are shuffled within each
+      bucket, split into batches, and the batches of all buckets are shuffled
+      together. Batches are lists of indices into the unsorted examples.
+      Batches have up to batch_size examples, or, if max_tokens is given, as
+      many examples as fit within max_tokens (batch size x longest budget
+      length). Either way, batches are additionally limited to
+      max_squared_tokens (batch size x longest budget length ^ 2), if given.
+      Budget lengths default to lengths.'''
+
+  def __init__(self, lengths, batch_size, bucket_size, shuffle=True,
+               budget_lengths=None, max_tokens=0, max_squared_tokens=0):
+    self.lengths = np.asarray(lengths, dtype=np.int64)
+    self.budget_lengths = self.lengths if budget_lengths is None else \
+                          np.asarray(budget_lengths, dtype=np.int64)
+    self.batch_size = batch_size
+    self.max_tokens = max_tokens
+    self.max_squared_tokens = max_squared_tokens
+    self.shuffle = shuffle
+    # Stable sort, so examples of equal lengths keep their original order.
+    self.order = np.argsort(-self.lengths, kind='mergesort')
+    examples_per_bucket = max(batch_size * bucket_size, 1)
+    self.buckets = [ self.order[start:start + examples_per_bucket] \
+                       for start in range(0, len(self.order), examples_per_bucket) ]
+
+  # Whether a batch of the given size and longest budget length is too large.
+  def exceeds_budget(self, size, max_len):
+    if self.max_tokens > 0:
+      if size * max_len > self.max_tokens:
+        return True
+    elif size > self.batch_size:
+      return True
+    return self.max_squared_tokens > 0 and \
+           size * max_len * max_len > self.max_squared_tokens
+
+  # Split the given example indices into batches. A single example exceeding
+  # the budget is still given its own batch.
+  def split(self, idxs):
+    batches, batch, max_len = [], [], 0
+    for idx in idxs:
+      new_max_len = max(max_len, self.budget_lengths[idx])
+      if len(batch) > 0 and self.exceeds_budget(len(batch) + 1, new_max_len):
+        batches.append(batch)
+        batch, new_max_len = [], self.budget_lengths[idx]
+      batch.append(idx)
+      max_len = new_max_len
+    if len(batch) > 0:
+      batches.append(batch)
+    return batches
+
+  # Get the batches (lists of example indices) for an epoch.
+  def batches(self):
+    batches = []
+    for bucket in self.buckets:
+      bucket = bucket.tolist()
+      if self.shuffle:
+        random.shuffle(bucket)
+      batches.extend(self.split(bucket))
+    if self.shuffle:
+      random.shuffle(batches)
+    return batches
+
+  # Fraction of padded tokens in the given batches, for sequences of the given
+  # per-example lengths (e.g. passages) padded to the longest in each batch.
+  def padding_ratio(self, batches, lengths):
+    lengths = np.asarray(lengths, dtype=np.int64)
+    padded, total = 0, 0
+    for batch in batches:
+      lens = lengths[batch]
+      padded += lens.max() * len(lens) - lens.sum()
+      total += lens.max() * len(lens)
+    return padded / float(max(total, 1))
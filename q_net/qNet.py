@@ -5,9 +5,81 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as f
 
+from Embeddings import is_vector_store, read_vectors
 from torch.autograd import Variable
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
+# Get the Python number held by a single element tensor. From PyTorch 0.4 on,
+# losses are 0-dim tensors, which can't be indexed.
+def scalar(tensor):
+  if hasattr(tensor, 'item'):
+    return tensor.item()
+  return tensor.data[0]
+
+class MatchLSTMRecurrence(nn.Module):
+  ''' Recurrence of a bi-directional match LSTM over stacked forward and backward
+      directions (see qNet.match_lstm), using the given layers of the model.
+      It can be compiled with TorchScript, to run the whole recurrence without
+      returning to Python at every step.'''
+
+  def __init__(self, attend_hidden, alpha_transform, lstm_cell):
+    super(MatchLSTMRecurrence, self).__init__()
+    self.attend_hidden = attend_hidden
+    self.alpha_transform = alpha_transform
+    self.lstm_cell = lstm_cell
+
+  # The memory attended to can differ at each step, or be shared by all steps,
+  # with a leading dimension of 1 instead of seq_len.
+  # {h,c}.shape = (2 * batch, hdim / 2)
+  # attended_memory.shape = (seq_len or 1, mem_len, 2 * batch, hdim)
+  # attended_passage.shape = (seq_len, 2 * batch, hdim), or (seq_len, 1, 1)
+  # Hp.shape = (seq_len, 2 * batch, hdim)
+  # memory.shape = (seq_len or 1, 2 * batch, mem_len, hdim)
+  # memory_bias.shape = (seq_len or 1, mem_len, 2 * batch, 1), added to
+  #   attention logits to exclude memory positions.
+  # keep.shape = (seq_len, 2 * batch, 1), 0 at padded positions and 1 elsewhere.
+  # Returns the hidden states, with shape (seq_len, 2 * batch, hdim / 2).
+  def forward(self, h, c, attended_memory, attended_passage, Hp, memory,
+              memory_bias, keep):
+    # type: (Tensor, Tensor, Tensor, Tensor, Tensor, Tensor, Tensor, Tensor) -> Tensor
+    # Inputs are split into steps with unbind rather than indexed at each step,
+    # so that their gradients are stacked once in the backward pass, instead of
+    # every step scattering into a full size gradient.
+    attended_memories = attended_memory.unbind(0)
+    attended_passages = attended_passage.unbind(0)
+    Hps = Hp.unbind(0)
+    memories = memory.unbind(0)
+    memory_biases = memory_bias.unbind(0)
+    keeps = keep.unbind(0)
+    H = []
+    for t in range(len(Hps)):
+      m = t if len(memories) > 1 else 0
+
+      # g.shape = (mem_len, 2 * batch, hdim)
+      g = torch.tanh(attended_memories[m] + attended_passages[t] +
+                     self.attend_hidden(h))
+
+      # alpha.shape = (mem_len, 2 * batch, 1)
+      alpha = f.softmax(self.alpha_transform(g) + memory_biases[m], dim=0)
+
+      # weighted_memory.shape = (2 * batch, hdim)
+      weighted_memory = torch.squeeze(torch.bmm(alpha.permute(1, 2, 0), memories[m]),
+                                      dim=1)
+
+      # z.shape = (2 * batch, 2 * hdim)
+      z = torch.cat((Hps[t], weighted_memory), dim=-1)
+
+      # Take forward and backward LSTM steps, with z as inputs.
+      h, c = self.lstm_cell(z, (h, c))
+
+      # Back to initial zero states for padded regions.
+      h = h * keeps[t]
+      c = c * keeps[t]
+
+      # h.shape = (2 * batch, hdim / 2)
+      H.append(h)
+    return torch.stack(H, dim=0)
+
 class qNet(nn.Module):
   ''' Q-NET model definition. Properties specified in config.'''
 
@@ -26,6 +98,10 @@ class qNet(nn.Module):
     # Volatile variables for inference. If true, computation graph isn't built.
     self.volatile = False
 
+    # Match LSTM recurrences compiled with TorchScript, by LSTM cell. These
+    # are compiled on first use, and not saved with the model.
+    self.compiled_recurrences = {}
+
   # Load configuration options
   def load_from_config(self, config):
     self.embed_size = config['embed_size']
@@ -38,6 +114,8 @@ class qNet(nn.Module):
     self.index_to_word = config['index_to_word']
     self.word_to_index = config['word_to_index']
     self.use_pretrained = config['use_pretrained']
+    # Half precision lookups are only supported on the GPU.
+    self.half_embeddings = config['half_embeddings'] and config['cuda']
     self.use_cuda = config['cuda']
     self.dropout = config['dropout']
     self.f1_loss_multiplier = config['f1_loss_multiplier']
@@ -48,6 +126,12 @@ class qNet(nn.Module):
     self.num_postprocessing_layers = config['num_postprocessing_layers']
     self.num_matchlstm_layers = config['num_matchlstm_layers']
     self.num_selfmatch_layers = config['num_selfmatch_layers']
+    self.match_layer_type = config['match_layer_type']
+    self.compile_match = config['compile_match']
+    self.selfmatch_window = config['selfmatch_window']
+    self.selfmatch_global = config['selfmatch_global']
+    assert not self.compile_match or hasattr(torch.jit, 'script'), \
+      "Compiling match layers requires a PyTorch version with TorchScript."
 
   def load_embeddings(self, debug_level):
     # Embedding look-up.
@@ -55,17 +139,23 @@ class qNet(nn.Module):
     self.oov_list = []
     known_idxs, unknown_idxs = [], []
     if self.use_pretrained and debug_level <= 1:
-      # Read embeddings from file.
-      embeddings = np.zeros((self.vocab_size, self.embed_size))
-      with open(self.vectors_path) as f:
-        for line in f:
-          word = line[:line.index(" ")]
-          if not word in self.word_to_index:
-            continue
-          line = line.split()
-          embeddings[self.word_to_index[line[0]]] = np.array(map(float,line[1:]))
-      for i, embedding in enumerate(embeddings):
-        if sum(embedding) == 0:
+      if is_vector_store(self.vectors_path):
+        # Gather the vocabulary's rows from a converted vector store.
+        embeddings, known = read_vectors(self.vectors_path, self.word_to_index,
+                                         self.vocab_size)
+      else:
+        # Read embeddings from a text file.
+        embeddings = np.zeros((self.vocab_size, self.embed_size))
+        with open(self.vectors_path) as f:
+          for line in f:
+            word = line[:line.index(" ")]
+            if not word in self.word_to_index:
+              continue
+            line = line.split()
+            embeddings[self.word_to_index[line[0]]] = np.array(map(float,line[1:]))
+        known = [ sum(embedding) != 0 for embedding in embeddings ]
+      for i, is_known in enumerate(known):
+        if not is_known:
           self.oov_count += 1
           self.oov_list.append(self.index_to_word[i])
           unknown_idxs.append(i)
@@ -81,15 +171,26 @@ class qNet(nn.Module):
       unknown_embeddings = np_rng.multivariate_normal(mean=known_mean, cov=known_covar,
                                                       size=len(unknown_idxs)).astype(np.float32)
       embeddings[unknown_idxs] = unknown_embeddings
-      self.embedding = embeddings
+      self.embedding = self.frozen_embedding(embeddings)
     elif debug_level >= 2:
       # Initialize all embeddings with zero for debugging.
-      self.embedding = np.zeros((self.vocab_size, self.embed_size))
+      self.embedding = \
+        self.frozen_embedding(np.zeros((self.vocab_size, self.embed_size)))
     else:
       # Create trainable embeddings layer.
       self.embedding = nn.Embedding(self.vocab_size, self.embed_size,
                                     self.word_to_index['<pad>'])
 
+  # Create an embedding layer with the given fixed vectors. Its weights aren't
+  # trained, and are optionally stored as float16 to halve their memory.
+  def frozen_embedding(self, embeddings):
+    embedding = nn.Embedding(self.vocab_size, self.embed_size)
+    embedding.weight.data.copy_(torch.from_numpy(embeddings.astype(np.float32)))
+    embedding.weight.requires_grad = False
+    if self.half_embeddings:
+      embedding = embedding.half()
+    return embedding
+
   def build_model(self, debug_level):
     # Read embeddings from file, create all zeros for debug, or make a trainable layer.
     self.load_embeddings(debug_level)
@@ -111,14 +212,23 @@ class qNet(nn.Module):
                         bias = False))
       setattr(self, 'attend_passage_for_passage_' + str(layer_no),
               nn.Linear(self.hidden_size, self.attention_size))
-      setattr(self, 'attend_passage_hidden_' + str(layer_no),
-              nn.Linear(self.hidden_size // 2, self.attention_size, bias = False))
+      if self.match_layer_type != 'precomputed':
+        setattr(self, 'attend_passage_hidden_' + str(layer_no),
+                nn.Linear(self.hidden_size // 2, self.attention_size, bias = False))
       setattr(self, 'passage_alpha_transform_' + str(layer_no),
               nn.Linear(self.attention_size, 1))
-      # Final Match-LSTM cells (bi-directional).
-      setattr(self, 'passage_match_lstm_' + str(layer_no),
-              nn.LSTMCell(input_size = self.hidden_size * 2,
-                          hidden_size = self.hidden_size // 2))
+      if self.match_layer_type == 'precomputed':
+        # Attention doesn't depend on the hidden state, so the Match-LSTM is a
+        # standard bi-directional LSTM over the attention-weighted inputs.
+        setattr(self, 'passage_match_lstm_' + str(layer_no),
+                nn.LSTM(input_size = self.hidden_size * 2,
+                        hidden_size = self.hidden_size // 2,
+                        bidirectional = True))
+      else:
+        # Final Match-LSTM cells (bi-directional).
+        setattr(self, 'passage_match_lstm_' + str(layer_no),
+                nn.LSTMCell(input_size = self.hidden_size * 2,
+                            hidden_size = self.hidden_size // 2))
       setattr(self, 'dropout_passage_matchlstm_' + str(layer_no),
               nn.Dropout(self.dropout))
 
@@ -191,6 +301,31 @@ class qNet(nn.Module):
     if self.f1_loss_multiplier > 0:
       del self.f1_loss
 
+  # Compiled recurrences can't be pickled. They are compiled again after
+  # loading.
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['compiled_recurrences'] = {}
+    return state
+
+  # Models are saved whole, so checkpoints of older versions lack attributes
+  # added since. Fill them in with values keeping the old behaviour.
+  def __setstate__(self, state):
+    super(qNet, self).__setstate__(state)
+    for name, default in [ ('half_embeddings', False),
+                           ('compile_match', False),
+                           ('compiled_recurrences', {}),
+                           ('selfmatch_window', 0),
+                           ('selfmatch_global', 4),
+                           ('match_layer_type', 'recurrent') ]:
+      if not name in self.__dict__:
+        setattr(self, name, default)
+    # Pre-trained embeddings used to be kept as a numpy matrix.
+    if isinstance(self.__dict__.get('embedding'), np.ndarray):
+      self.embedding = self.frozen_embedding(self.__dict__.pop('embedding'))
+      if self.use_cuda:
+        self.embedding = self.embedding.cuda()
+
   def load_from_file(self, path):
     self = torch.load(path)
     return self
@@ -229,36 +364,32 @@ class qNet(nn.Module):
 
   # inp.shape = (seq_len, batch)
   # output.shape = (seq_len, batch, embed_size)
-  def get_vector_embeddings(self, inp):
-    return self.placeholder(self.embedding[inp])
-
-  # Detach input of (seq_len, batch, ...) for the given indices,
-  # and fill it with the specified value.
-  def detach3d(self, vals, mask_idxs, fill_val):
-    if len(mask_idxs[0]) == 0:
-      return vals
-    vals = vals.clone()
-    vals[mask_idxs[0], mask_idxs[1], :] = \
-      vals[mask_idxs[0], mask_idxs[1], :].detach().fill_(fill_val)
-    return vals
-
-  # Detach input of (batch, ...) for the given input, for the given
-  # indices, and fill it with the specified value.
-  def detach2d(self, vals, mask_t, fill_val):
-    if len(mask_t) == 0:
-      return vals
-    vals = vals.clone()
-    vals[mask_t, :] = vals[mask_t, :].detach().fill_(fill_val)
-    return vals
-
-  # Softmax over unmasked idxs for each item in the batch, and pad the rest
-  # with zeros. Softmax is done along dimension 0.
+  def get_embeddings(self, inp):
+    embedded = torch.transpose(self.embedding(torch.t(inp)), 0, 1)
+    if self.half_embeddings:
+      embedded = embedded.float()
+    return embedded
+
+  # Get a mask of shape (seq_len, batch), that is 1 at padded positions, beyond
+  # the length of each item in the batch, and 0 elsewhere.
+  def get_mask(self, max_len, lens):
+    positions = self.variable(torch.arange(0, max_len).long()).unsqueeze(1)
+    lens = self.variable(torch.from_numpy(np.asarray(lens, dtype=np.int64)))
+    return positions >= lens.unsqueeze(0)
+
+  # Zero out values of shape (seq_len, batch, ...) at padded positions of the
+  # given (seq_len, batch) mask. Also works for a single step, with values of
+  # shape (batch, ...) and a (batch) mask.
+  def mask_padding(self, vals, mask):
+    return vals * (1 - mask.float()).unsqueeze(-1)
+
+  # Log-softmax over unmasked positions for each item in the batch, with -inf
+  # (zero probability) at padded positions. Done along dimension 0.
+  # vals.shape = (seq_len, batch, 1), mask.shape = (seq_len, batch)
   # Returned tensor shape = (seq_len, batch, 1)
-  def padded_softmax(self, vals, mask_idxs):
-    vals = self.detach3d(vals, mask_idxs, -float('inf'))
-    softmaxed = f.softmax(vals, dim=0)
-    softmaxed = self.detach3d(softmaxed, mask_idxs, 0.0)
-    return softmaxed
+  def masked_log_softmax(self, vals, mask):
+    vals = vals.masked_fill(mask.unsqueeze(-1).expand_as(vals), -float('inf'))
+    return f.log_softmax(vals, dim=0)
 
   # Get final layer hidden states of the provided LSTM run over the given
   # input sequence.
@@ -276,157 +407,239 @@ class qNet(nn.Module):
                            self.variable(torch.arange(idxs.size()[0])).long())
     return torch.index_select(H, 1, unsorted_idxs)
 
+  # Get a tensor with the given tensor reversed along dimension 0.
+  def reverse(self, vals, max_len):
+    reversed_idxs = self.variable(torch.arange(max_len - 1, -1, -1).long())
+    return torch.index_select(vals, 0, reversed_idxs)
+
+  # Get the memory attended to by both directions of a match LSTM, when it is
+  # the same for all steps.
+  # memory.shape = (mem_len, batch, hdim)
+  # attended_memory.shape = (mem_len, batch, hdim)
+  # Returns the memory, attended memory and memory bias shared by all steps,
+  # with the shapes of MatchLSTMRecurrence inputs.
+  def stack_memory(self, memory, attended_memory):
+    stacked_memory = torch.transpose(torch.cat((memory, memory), dim=1), 0, 1)
+    stacked_attended_memory = torch.cat((attended_memory, attended_memory), dim=1)
+    memory_bias = self.variable(torch.zeros(1, 1, 1, 1))
+    return (stacked_memory.unsqueeze(0), stacked_attended_memory.unsqueeze(0),
+            memory_bias)
+
+  # Get the memory attended to by both directions of a self-matching LSTM at
+  # each step: passage positions within the given window around the step's
+  # position, and num_global summaries of the passage, each the mean of one of
+  # num_global equal segments of the passage. Padded window positions, and
+  # empty segments of short passages, are excluded from attention.
+  # Hr.shape = attended_passage.shape = (seq_len, batch, hdim)
+  # mask_p.shape = (seq_len, batch)
+  # Returns the memory, attended memory and memory bias of each step, with the
+  # shapes of MatchLSTMRecurrence inputs, where mem_len = 2 * window + 1 +
+  # num_global.
+  def windowed_memory(self, Hr, attended_passage, mask_p, max_passage_len,
+                      window, num_global):
+    window_len = 2 * window + 1
+    # Positions of the window of each step, in the passage padded by window
+    # positions on each side.
+    # window_idxs.shape = (seq_len * window_len)
+    window_idxs = torch.arange(0, max_passage_len).long().unsqueeze(1) + \
+                  torch.arange(0, window_len).long().unsqueeze(0)
+    window_idxs = self.variable(window_idxs.view(-1))
+    # Get the windows of the given values of each step, with both directions
+    # stacked. Positions of the backward direction are reversed, as in its
+    # inputs. Windows are gathered with index_select, whose backward pass is a
+    # single index_add, rather than sliced out at each step.
+    # vals.shape = (seq_len, batch, ...)
+    # Returns windows with shape (seq_len, window_len, 2 * batch, ...).
+    def windows(vals, pad_val):
+      stacked = torch.cat((vals, self.reverse(vals, max_passage_len)), dim=1)
+      padding = self.variable(torch.zeros(*((window,) + tuple(stacked.size()[1:]))))
+      padding = padding + pad_val
+      padded = torch.cat((padding, stacked, padding), dim=0)
+      return padded.index_select(0, window_idxs).view(
+               *((max_passage_len, window_len) + tuple(stacked.size()[1:])))
+
+    # memory.shape = (seq_len, 2 * batch, window_len, hdim)
+    # attended_memory.shape = (seq_len, window_len, 2 * batch, hdim)
+    # excluded.shape = (seq_len, window_len, 2 * batch)
+    memory = windows(Hr, 0).permute(0, 2, 1, 3)
+    attended_memory = windows(attended_passage, 0)
+    excluded = windows(mask_p.float(), 1)
+
+    if num_global > 0:
+      # Weights of the passage positions in each segment's mean.
+      # segment_weights.shape = (batch, num_global, seq_len)
+      lens = (1 - mask_p.float()).sum(0)
+      positions = self.variable(torch.arange(0, max_passage_len)).unsqueeze(1)
+      segments = torch.floor(positions * num_global / lens.unsqueeze(0))
+      segment_weights = []
+      for segment in range(num_global):
+        segment_weights.append((segments == segment).float() * (1 - mask_p.float()))
+      segment_weights = torch.stack(segment_weights, dim=0)
+      segment_lens = segment_weights.sum(1)
+      segment_weights = segment_weights / torch.clamp(segment_lens, min=1).unsqueeze(1)
+      segment_weights = segment_weights.permute(2, 0, 1)
+
+      # summaries.shape = (2 * batch, num_global, hdim)
+      # attended_summaries.shape = (num_global, 2 * batch, hdim)
+      # summary_excluded.shape = (num_global, 2 * batch)
+      summaries = torch.bmm(segment_weights, torch.transpose(Hr, 0, 1))
+      summaries = torch.cat((summaries, summaries), dim=0)
+      attended_summaries = torch.transpose(
+        torch.bmm(segment_weights, torch.transpose(attended_passage, 0, 1)), 0, 1)
+      attended_summaries = torch.cat((attended_summaries, attended_summaries), dim=1)
+      summary_excluded = (segment_lens == 0).float()
+      summary_excluded = torch.cat((summary_excluded, summary_excluded), dim=1)
+
+      memory = torch.cat(
+        (memory, summaries.unsqueeze(0).expand(
+                   *((max_passage_len,) + tuple(summaries.size())))), dim=2)
+      attended_memory = torch.cat(
+        (attended_memory, attended_summaries.unsqueeze(0).expand(
+                            *((max_passage_len,) + tuple(attended_summaries.size())))),
+        dim=1)
+      excluded = torch.cat(
+        (excluded, summary_excluded.unsqueeze(0).expand(
+                     *((max_passage_len,) + tuple(summary_excluded.size())))), dim=1)
+
+    # A large negative bias rather than -inf, so that steps at padded positions,
+    # with all memory excluded, don't produce NaNs.
+    memory_bias = excluded.unsqueeze(-1) * -1e30
+    return memory, attended_memory, memory_bias
+
+  # Run a bi-directional match LSTM over the passage, attending to the given
+  # memory (the question, or the passage itself) at each step.
+  # The forward and backward directions share the attention layers and the
+  # LSTM cell, so both are run at once, stacked along the batch dimension:
+  # rows [0, batch) of each step are the forward direction, and rows
+  # [batch, 2 * batch) are the backward direction, reading the passage reversed.
+  # Hp.shape = (seq_len, batch, hdim)
+  # memory = (memory, attended_memory, memory_bias), of each step or shared by
+  #   all steps, from stack_memory or windowed_memory.
+  # attended_passage.shape = (seq_len, batch, hdim), or None if the attention
+  # doesn't depend on the passage position.
+  def match_lstm(self, Hp, memory, attended_passage, attend_hidden,
+                 alpha_transform, lstm_cell, max_passage_len, batch_size, mask_p):
+    # Initial hidden and cell states for the stacked forward and backward LSTMs.
+    # {h,c}.shape = (2 * batch, hdim / 2)
+    h, c = self.get_initial_lstm(2 * batch_size, self.hidden_size // 2)
+
+    # Stack both directions. The passage terms of each step are sliced out of
+    # the stacked passage tensors, and broadcast over the memory.
+    # stacked_attended_passage.shape = (seq_len, 2 * batch, hdim), or zeros
+    #   with shape (seq_len, 1, 1) if the passage isn't attended to.
+    # stacked_Hp.shape = (seq_len, 2 * batch, hdim)
+    step_memory, step_attended_memory, step_memory_bias = memory
+    if attended_passage is not None:
+      stacked_attended_passage = \
+        torch.cat((attended_passage,
+                   self.reverse(attended_passage, max_passage_len)), dim=1)
+    else:
+      stacked_attended_passage = self.variable(torch.zeros(max_passage_len, 1, 1))
+    stacked_Hp = torch.cat((Hp, self.reverse(Hp, max_passage_len)), dim=1)
+    # stacked_keep.shape = (seq_len, 2 * batch, 1)
+    stacked_mask_p = torch.cat((mask_p, self.reverse(mask_p, max_passage_len)),
+                               dim=1)
+    stacked_keep = (1 - stacked_mask_p.float()).unsqueeze(-1)
+
+    recurrence = MatchLSTMRecurrence(attend_hidden, alpha_transform, lstm_cell)
+    if self.compile_match:
+      if lstm_cell not in self.compiled_recurrences:
+        self.compiled_recurrences[lstm_cell] = torch.jit.script(recurrence)
+      recurrence = self.compiled_recurrences[lstm_cell]
+    # H.shape = (seq_len, 2 * batch, hdim / 2)
+    H = recurrence(h, c, step_attended_memory, stacked_attended_passage,
+                   stacked_Hp, step_memory, step_memory_bias, stacked_keep)
+
+    # H{f,b}.shape = (seq_len, batch, hdim / 2)
+    Hf = H[:, :batch_size]
+    Hb = self.reverse(H[:, batch_size:], max_passage_len)
+
+    # Hr.shape = (seq_len, batch, hdim)
+    Hr = torch.cat((Hf, Hb), dim=-1)
+    return Hr
+
   # Get a question-aware passage representation.
   def match_question_passage(self, layer_no, Hpi, Hq, max_passage_len,
-                             batch_size, mask_p_idxs, mask_p_ts, mask_q_idxs,
-                             mask_q_ts):
-    # Initial hidden and cell states for forward and backward LSTMs.
-    # {h,c}{f,b}.shape = (batch, hdim / 2)
-    hf, cf = self.get_initial_lstm(batch_size, self.hidden_size // 2)
-    hb, cb = self.get_initial_lstm(batch_size, self.hidden_size // 2)
-
-    # Get vectors zi for each i in passage.
+                             passage_lens, batch_size, mask_p, mask_q):
     # Attended question is the same at each time step. Just compute it once.
     # attended_{question,passage}.shape = (seq_len, batch, hdim)
     attended_question = getattr(self, 'attend_question_for_passage_' + layer_no)(Hq)
     attended_passage = getattr(self, 'attend_passage_for_passage_' + layer_no)(Hpi)
-    attended_question = self.detach3d(attended_question, mask_q_idxs, 0.0)
-    attended_passage = self.detach3d(attended_passage, mask_p_idxs, 0.0)
-    attention_q_plus_p = []
-    for t in range(max_passage_len):
-      attention_q_plus_p.append(attended_question + attended_passage[t])
-    transposed_Hq = torch.transpose(Hq, 0, 1)
-    Hf, Hb = [], []
-    for i in range(max_passage_len):
-      forward_idx = i
-      backward_idx = max_passage_len-i-1
-      # g{f,b}.shape = (seq_len, batch, hdim)
-      gf = f.tanh(attention_q_plus_p[forward_idx] + \
-               getattr(self, 'attend_passage_hidden_' + layer_no)(hf))
-      gb = f.tanh(attention_q_plus_p[backward_idx] + \
-               getattr(self, 'attend_passage_hidden_' + layer_no)(hb))
-
-      # alpha_{f,g}.shape = (seq_len, batch, 1)
-      alpha_f = getattr(self, 'passage_alpha_transform_' + layer_no)(gf)
-      alpha_b = getattr(self, 'passage_alpha_transform_' + layer_no)(gb)
-
-      # Masking unnecessary here, as the values are already zero.
-      alpha_f = f.softmax(alpha_f, dim=0)
-      alpha_b = f.softmax(alpha_b, dim=0)
-
-      # Hp[{forward,backward}_idx].shape = (batch, hdim)
-      # Hq = (seq_len, batch, hdim)
-      # weighted_Hq_f.shape = (batch, hdim)
-      weighted_Hq_f = torch.squeeze(torch.bmm(alpha_f.permute(1, 2, 0),
-                                    transposed_Hq), dim=1)
-      weighted_Hq_b = torch.squeeze(torch.bmm(alpha_b.permute(1, 2, 0),
-                                    transposed_Hq), dim=1)
-
-      # z{f,b}.shape = (batch, 2 * hdim)
-      zf = torch.cat((Hpi[forward_idx], weighted_Hq_f), dim=-1)
-      zb = torch.cat((Hpi[backward_idx], weighted_Hq_b), dim=-1)
-
-      # Take forward and backward LSTM steps, with zf and zb as inputs.
-      hf, cf = getattr(self, 'passage_match_lstm_' + layer_no)(zf, (hf, cf))
-      hb, cb = getattr(self, 'passage_match_lstm_' + layer_no)(zb, (hb, cb))
-
-      # Back to initial zero states for padded regions.
-      hf = self.detach2d(hf, mask_p_ts[forward_idx], 0.0)
-      hb = self.detach2d(hb, mask_p_ts[backward_idx], 0.0)
-      cf = self.detach2d(cf, mask_p_ts[forward_idx], 0.0)
-      cb = self.detach2d(cb, mask_p_ts[backward_idx], 0.0)
-
-      # Append hidden states to create Hf and Hb matrices.
-      # h{f,b}.shape = (batch, hdim / 2)
-      Hf.append(hf)
-      Hb.append(hb)
-
-    # H{f,b}.shape = (seq_len, batch, hdim / 2)
-    Hb = Hb[::-1]
-    Hf = torch.stack(Hf, dim=0)
-    Hb = torch.stack(Hb, dim=0)
-
-    # Hr.shape = (seq_len, batch, hdim)
-    Hr = torch.cat((Hf, Hb), dim=-1)
+    attended_question = self.mask_padding(attended_question, mask_q)
+    attended_passage = self.mask_padding(attended_passage, mask_p)
+    if self.match_layer_type == 'precomputed':
+      return self.precomputed_match(layer_no, Hpi, Hq, attended_question,
+                                    attended_passage, max_passage_len,
+                                    passage_lens, batch_size, mask_p, mask_q)
+    memory = self.stack_memory(Hq, attended_question)
+    return self.match_lstm(Hpi, memory, attended_passage,
+                           getattr(self, 'attend_passage_hidden_' + layer_no),
+                           getattr(self, 'passage_alpha_transform_' + layer_no),
+                           getattr(self, 'passage_match_lstm_' + layer_no),
+                           max_passage_len, batch_size, mask_p)
+
+  # Question-passage match layer with question attention that doesn't depend
+  # on the match LSTM hidden state, unlike Wang & Jiang's, so that it is
+  # computed for all passage positions at once. The attention-weighted
+  # question and passage are then run through a standard (packed)
+  # bi-directional LSTM, instead of stepping through an LSTM cell.
+  # attended_question.shape = (ques_len, batch, hdim)
+  # attended_passage.shape = (seq_len, batch, hdim)
+  def precomputed_match(self, layer_no, Hpi, Hq, attended_question,
+                        attended_passage, max_passage_len, passage_lens,
+                        batch_size, mask_p, mask_q):
+    max_question_len = Hq.size(0)
+    # g.shape = (ques_len, seq_len, batch, hdim)
+    g = torch.tanh(attended_question.unsqueeze(1) + attended_passage.unsqueeze(0))
+
+    # Attention over the question for each passage position, excluding padded
+    # question positions.
+    # alpha.shape = (ques_len, seq_len, batch, 1)
+    alpha = getattr(self, 'passage_alpha_transform_' + layer_no)(g)
+    alpha = torch.exp(self.masked_log_softmax(
+              alpha, mask_q.unsqueeze(1).expand(max_question_len,
+                                                max_passage_len, batch_size)))
+
+    # weighted_question.shape = (seq_len, batch, hdim)
+    weighted_question = torch.bmm(alpha.squeeze(-1).permute(2, 1, 0),
+                                  torch.transpose(Hq, 0, 1))
+    weighted_question = torch.transpose(weighted_question, 0, 1)
+
+    # z.shape = (seq_len, batch, 2 * hdim)
+    z = torch.cat((Hpi, weighted_question), dim=-1)
+    Hr = self.process_input_with_lstm(z, max_passage_len, passage_lens, batch_size,
+                                      getattr(self, 'passage_match_lstm_' + layer_no))
     return Hr
 
   # Get a self-aware (question-aware) passage representation.
   def match_passage_passage(self, layer_no, Hr, max_passage_len, batch_size,
-                            mask_p_idxs, mask_p_ts):
-    # Initial hidden and cell states for forward and backward LSTMs.
-    # {h,c}{f,b}.shape = (batch, hdim / 2)
-    hf, cf = self.get_initial_lstm(batch_size, self.hidden_size // 2)
-    hb, cb = self.get_initial_lstm(batch_size, self.hidden_size // 2)
-
-    # Get vectors zi for each i in passage.
+                            mask_p):
     # Attended passage is the same at each time step. Just compute it once.
     # attended_passage.shape = (seq_len, batch, hdim)
     attended_passage = getattr(self, 'attend_self_passage_' + layer_no)(Hr)
-    attended_passage = self.detach3d(attended_passage, mask_p_idxs, 0.0)
-    transposed_Hr = torch.transpose(Hr, 0, 1)
-    Hf, Hb = [], []
-    for i in range(max_passage_len):
-      forward_idx = i
-      backward_idx = max_passage_len-i-1
-      # g{f,b}.shape = (seq_len, batch, hdim)
-      gf = f.tanh(attended_passage + \
-               getattr(self, 'attend_self_hidden_' + layer_no)(hf))
-      gb = f.tanh(attended_passage + \
-               getattr(self, 'attend_self_hidden_' + layer_no)(hb))
-
-      # alpha_{f,g}.shape = (seq_len, batch, 1)
-      alpha_f = getattr(self, 'self_alpha_transform_' + layer_no)(gf)
-      alpha_b = getattr(self, 'self_alpha_transform_' + layer_no)(gb)
-
-      # Masking unnecessary here, as the values are already zero.
-      alpha_f = f.softmax(alpha_f, dim=0)
-      alpha_b = f.softmax(alpha_b, dim=0)
-
-      # Hr[{forward,backward}_idx].shape = (batch, hdim)
-      # weighted_Hr_{f,b}.shape = (batch, hdim)
-      weighted_Hr_f = torch.squeeze(torch.bmm(alpha_f.permute(1, 2, 0),
-                                    transposed_Hr), dim=1)
-      weighted_Hr_b = torch.squeeze(torch.bmm(alpha_b.permute(1, 2, 0),
-                                    transposed_Hr), dim=1)
-
-      # z{f,b}.shape = (batch, 2 * hdim)
-      zf = torch.cat((Hr[forward_idx], weighted_Hr_f), dim=-1)
-      zb = torch.cat((Hr[backward_idx], weighted_Hr_b), dim=-1)
-
-      # Take forward and backward LSTM steps, with zf and zb as inputs.
-      hf, cf = getattr(self, 'self_match_lstm_' + layer_no)(zf, (hf, cf))
-      hb, cb = getattr(self, 'self_match_lstm_' + layer_no)(zb, (hb, cb))
-
-      # Back to initial zero states for padded regions.
-      hf = self.detach2d(hf, mask_p_ts[forward_idx], 0.0)
-      hb = self.detach2d(hb, mask_p_ts[backward_idx], 0.0)
-      cf = self.detach2d(cf, mask_p_ts[forward_idx], 0.0)
-      cb = self.detach2d(cb, mask_p_ts[backward_idx], 0.0)
-
-      # Append hidden states to create Hf and Hb matrices.
-      # h{f,b}.shape = (batch, hdim / 2)
-      Hf.append(hf)
-      Hb.append(hb)
-
-    # H{f,b}.shape = (seq_len, batch, hdim / 2)
-    Hb = Hb[::-1]
-    Hf = torch.stack(Hf, dim=0)
-    Hb = torch.stack(Hb, dim=0)
-
-    # Hr.shape = (seq_len, batch, hdim)
-    Hr = torch.cat((Hf, Hb), dim=-1)
-    return Hr
-
-  # Boundary pointer model, that gives probability distributions over the
-  # start and end indices. Returns the hidden states, as well as the predicted
-  # distributions.
-  def answer_pointer(self, Hr, Hp, Hq, mask_p_idxs, mask_p_ts, mask_q_idxs,
-                     mask_q_ts, batch_size):
+    attended_passage = self.mask_padding(attended_passage, mask_p)
+    # Attend to the whole passage, or to a window around each position and a
+    # few passage summaries.
+    if self.selfmatch_window > 0:
+      memory = self.windowed_memory(Hr, attended_passage, mask_p, max_passage_len,
+                                    self.selfmatch_window, self.selfmatch_global)
+    else:
+      memory = self.stack_memory(Hr, attended_passage)
+    return self.match_lstm(Hr, memory, None,
+                           getattr(self, 'attend_self_hidden_' + layer_no),
+                           getattr(self, 'self_alpha_transform_' + layer_no),
+                           getattr(self, 'self_match_lstm_' + layer_no),
+                           max_passage_len, batch_size, mask_p)
+
+  # Boundary pointer model, that gives log-probability distributions over the
+  # start and end indices, from both the forward (start, then end) and the
+  # backward (end, then start) pointers.
+  def answer_pointer(self, Hr, Hp, Hq, mask_p, mask_q, batch_size):
     # attended_input.shape = (seq_len, batch, hdim)
     attended_input = getattr(self, 'attend_input')(Hr)
     attended_input_b = getattr(self, 'attend_input_b')(Hr)
-    attended_input = self.detach3d(attended_input, mask_p_idxs, 0.0)
-    attended_input_b = self.detach3d(attended_input_b, mask_p_idxs, 0.0)
+    attended_input = self.mask_padding(attended_input, mask_p)
+    attended_input_b = self.mask_padding(attended_input_b, mask_p)
 
     # weighted_Hq.shape = (batch, hdim)
     attended_question = f.tanh(getattr(self, 'attend_question')(Hq))
@@ -461,13 +674,13 @@ class qNet(nn.Module):
       beta_k_b = getattr(self, 'beta_transform')(Fk_b)
 
       # Mask out padded regions.
-      beta_k = self.padded_softmax(beta_k, mask_p_idxs)
-      beta_k_b = self.padded_softmax(beta_k_b, mask_p_idxs)
+      log_beta_k = self.masked_log_softmax(beta_k, mask_p)
+      log_beta_k_b = self.masked_log_softmax(beta_k_b, mask_p)
 
-      # Store distributions produced at start and end prediction steps.
+      # Store (log) distributions produced at start and end prediction steps.
       if k > 0:
-        answer_distributions.append(torch.t(torch.squeeze(beta_k, dim=-1)))
-        answer_distributions_b.append(torch.t(torch.squeeze(beta_k_b, dim=-1)))
+        answer_distributions.append(torch.t(torch.squeeze(log_beta_k, dim=-1)))
+        answer_distributions_b.append(torch.t(torch.squeeze(log_beta_k_b, dim=-1)))
 
       # Only the first two steps of the answer pointer are useful beyond
       # this point.
@@ -475,6 +688,8 @@ class qNet(nn.Module):
         break
 
       # weighted_Hr.shape = (batch, hdim)
+      beta_k = torch.exp(log_beta_k)
+      beta_k_b = torch.exp(log_beta_k_b)
       weighted_Hr = torch.squeeze(torch.bmm(beta_k.permute(1, 2, 0),
                                             torch.transpose(Hr, 0, 1)), dim=1)
       weighted_Hr_b = torch.squeeze(torch.bmm(beta_k_b.permute(1, 2, 0),
@@ -490,25 +705,45 @@ class qNet(nn.Module):
 
     return answer_distributions, answer_distributions_b
 
-  # Boundary pointer model, that gives probability distributions over the
+  # Element-wise log(exp(a) + exp(b)), computed without overflow.
+  def log_add_exp(self, a, b):
+    max_ab = torch.max(a, b)
+    return max_ab + torch.log(torch.exp(a - max_ab) + torch.exp(b - max_ab))
+
+  # log(sum(exp(values))) along dimension dim, computed without overflow or
+  # underflow. The maximum along dim must be finite.
+  def log_sum_exp(self, values, dim):
+    max_values = torch.max(values, dim, keepdim=True)[0].detach()
+    return (max_values + torch.log(torch.exp(values - max_values) \
+                                     .sum(dim, keepdim=True))).squeeze(dim)
+
+  # Boundary pointer model, that gives log-probability distributions over the
   # answer start and answer end indices. Additionally returns the loss
   # for training.
   def point_at_answer(self, Hr, Hp, Hq, batch_size, answer, f1_matrices,
-                      mask_p_idxs, mask_p_ts, mask_q_idxs, mask_q_ts):
+                      mask_p, mask_q):
     # Predict the answer start and end indices.
-    distribution = self.answer_pointer(Hr, Hp, Hq, mask_p_idxs, mask_p_ts,
-                                       mask_q_idxs, mask_q_ts, batch_size)
-
-    batch_losses = [ [] for _ in range(batch_size) ]
-    # For each example in the batch, add the negative log of answer start
-    # and end index probabilities to the MLE loss, from both forward and
-    # backward answer pointers.
-    for idx in range(batch_size):
-      batch_losses[idx].append(
-        distribution[0][0][idx, answer[0][idx]] *\
-        distribution[0][1][idx, answer[1][idx]] *\
-        distribution[1][0][idx, answer[1][idx]] *\
-        distribution[1][1][idx, answer[0][idx]])
+    distribution = self.answer_pointer(Hr, Hp, Hq, mask_p, mask_q, batch_size)
+
+    # Log-probabilities of the answer start and end indices under the forward
+    # and backward answer pointers, gathered for the whole batch.
+    # answer_idxs.shape = (2, batch, 1)
+    # log_mle.shape = (batch)
+    answer_idxs = self.variable(
+      torch.from_numpy(np.asarray(answer, dtype=np.int64))).unsqueeze(-1)
+    def log_prob(log_dist, idxs):
+      return torch.gather(log_dist, 1, idxs).squeeze(1)
+    log_mle = log_prob(distribution[0][0], answer_idxs[0]) + \
+              log_prob(distribution[0][1], answer_idxs[1]) + \
+              log_prob(distribution[1][0], answer_idxs[1]) + \
+              log_prob(distribution[1][1], answer_idxs[0])
+
+    # The loss is the negative log of the mean of the MLE and (weighted) F1
+    # terms, computed in log-space.
+    log_normalizer = float(np.log(1 + self.f1_loss_multiplier))
+    mle_loss = (log_normalizer - log_mle).mean()
+    f1_loss = 0
+    loss = mle_loss
     if self.f1_loss_multiplier > 0:
       # Compute the F1 distribution loss.
       # f1_matrices.shape = (batch, max_seq_len, max_seq_len)
@@ -518,47 +753,79 @@ class qNet(nn.Module):
                                        to_float = True)
       else:
         f1_matrices = self.placeholder(f1_matrices)
-      loss_f1_f = (torch.bmm(torch.unsqueeze(distribution[0][0], -1),
-                             torch.unsqueeze(distribution[0][1], 1)) * \
-                   f1_matrices).view(batch_size, -1).sum(1)
-      loss_f1_b = (torch.bmm(torch.unsqueeze(distribution[1][1], -1),
-                             torch.unsqueeze(distribution[1][0], 1)) * \
-                   f1_matrices).view(batch_size, -1).sum(1)
-      for idx in range(batch_size):
-        batch_losses[idx].append(self.f1_loss_multiplier * loss_f1_f[idx] *\
-                                 loss_f1_b[idx])
-
-    loss = 0.0
-    mle_loss = 0
-    f1_loss = 0
-    for idx in range(batch_size):
-      loss += -torch.log(sum(batch_losses[idx]) / (1 + self.f1_loss_multiplier))
-      mle_loss += -torch.log(batch_losses[idx][0] / (1 + self.f1_loss_multiplier))
-      if self.f1_loss_multiplier > 0:
-        f1_loss += -torch.log(batch_losses[idx][1] / (1 + self.f1_loss_multiplier))
-    loss /= batch_size
-    mle_loss /= batch_size
-    f1_loss /= batch_size
+      # The expected F1 under each answer pointer is a sum over (start, end)
+      # cells, computed in log-space so that it doesn't underflow when the
+      # predictions are far from the answer. Cells with zero F1 get a large
+      # negative log-F1 rather than -inf, so that examples without any
+      # positive F1 cells still get finite gradients.
+      # log_f1_matrices.shape = (batch, max_seq_len, max_seq_len)
+      log_f1_matrices = \
+        torch.log(f1_matrices).masked_fill(f1_matrices <= 0, -1e30)
+      def log_expected_f1(log_start, log_end):
+        log_cells = log_start.unsqueeze(2) + log_end.unsqueeze(1) + \
+                    log_f1_matrices
+        return self.log_sum_exp(log_cells.view(batch_size, -1), 1)
+      # log_f1.shape = (batch)
+      log_f1 = float(np.log(self.f1_loss_multiplier)) + \
+               log_expected_f1(*distribution[0]) + \
+               log_expected_f1(distribution[1][1], distribution[1][0])
+      f1_loss = (log_normalizer - log_f1).mean()
+      loss = (log_normalizer - self.log_add_exp(log_mle, log_f1)).mean()
     return distribution, loss, mle_loss, f1_loss
 
-  # Get idxs to be padded for the given input, for the given maximum length,
-  # for lengths in the batch.
-  def get_mask_idxs(self, batch_size, max_len, lens):
-    mask_idxs = [[], []]
-    mask_ts = [ [] for _ in range(max_len) ]
-    for t in range(max_len):
-      for idx in range(batch_size):
-        if t >= lens[idx]:
-          mask_idxs[0].append(t)
-          mask_idxs[1].append(idx)
-          mask_ts[t].append(idx)
-    return mask_idxs, mask_ts
+  # Decode the k most probable answer spans of each example in the batch, from
+  # the predicted log distributions. A span's score is the product of its start
+  # and end probabilities under both answer pointers. Only spans within the
+  # passage, of at most max_span tokens (unless max_span is -1), are scored:
+  # log_score[b, start, width] = start[b, start] + end[b, start + width] in
+  # log-space, computed for the whole batch at once, over a band of widths.
+  # distributions[{0,1}][{0,1}].shape = (batch, max_passage_len)
+  # Returns a list of up to k (start, end, score) tuples per example, in
+  # decreasing order of score.
+  def decode_spans(self, distributions, passage_lens, max_span=-1, k=1):
+    # {start,end}_scores.shape = (batch, max_passage_len)
+    start_scores = (distributions[0][0] + distributions[1][1]).data
+    end_scores = (distributions[0][1] + distributions[1][0]).data
+    batch_size, max_len = start_scores.size()
+    if max_span < 0 or max_span > max_len:
+      max_span = max_len
+
+    # Band of end scores for each start.
+    # end_band.shape = scores.shape = (batch, max_passage_len, max_span)
+    end_scores = torch.cat((end_scores,
+                            end_scores.new(batch_size, max_span - 1).fill_(-float('inf'))),
+                           dim=1)
+    end_band = end_scores.unfold(1, max_span, 1)
+    scores = start_scores.unsqueeze(2) + end_band
+
+    # Mask out spans ending beyond the passage.
+    positions = torch.arange(0, max_len).type_as(scores)
+    widths = torch.arange(0, max_span).type_as(scores)
+    ends = (positions.unsqueeze(1) + widths.unsqueeze(0)).unsqueeze(0)
+    lens = torch.from_numpy(np.asarray(passage_lens, dtype=np.float32))
+    lens = lens.type_as(scores).view(batch_size, 1, 1)
+    scores.masked_fill_((ends.expand_as(scores) >= lens.expand_as(scores)),
+                        -float('inf'))
+
+    k = min(k, max_len * max_span)
+    top_scores, top_idxs = torch.topk(scores.contiguous().view(batch_size, -1), k,
+                                      dim=1)
+    top_scores = top_scores.cpu().numpy()
+    top_idxs = top_idxs.cpu().numpy()
+    spans = []
+    for idx in range(batch_size):
+      starts = top_idxs[idx] // max_span
+      ends = starts + top_idxs[idx] % max_span
+      spans.append([ (int(start), int(end), float(np.exp(score))) \
+                       for start, end, score in zip(starts, ends, top_scores[idx]) \
+                         if score > -float('inf') ])
+    return spans
 
   # Forward pass method.
   # passage = tuple((seq_len, batch), len_within_batch)
   # question = tuple((seq_len, batch), len_within_batch)
   # answer = tuple((2, batch))
-  # f1_matrices = (batch, seq_len, seq_len)
+  # f1_matrices = (batch, seq_len, seq_len), None if the F1 loss is disabled.
   # question_pos_tags = (seq_len, batch, num_pos_tags)
   # question_ner_tags = (seq_len, batch, num_ner_tags)
   # passage_pos_tags = (seq_len, batch, num_pos_tags)
@@ -567,9 +834,8 @@ class qNet(nn.Module):
   def forward(self, passage, question, answer, f1_matrices,
               question_pos_tags, question_ner_tags, passage_pos_tags,
               passage_ner_tags, answer_sentence):
-    if not self.use_pretrained:
-      padded_passage = self.placeholder(passage[0], False)
-      padded_question = self.placeholder(question[0], False)
+    padded_passage = self.placeholder(passage[0], False)
+    padded_question = self.placeholder(question[0], False)
     batch_size = passage[0].shape[1]
     max_passage_len = passage[0].shape[0]
     max_question_len = question[0].shape[0]
@@ -579,19 +845,14 @@ class qNet(nn.Module):
     if self.debug_level >= 3:
       start_prepare = time.time()
 
-    # Indices of values to be masked out.
-    mask_p_idxs, mask_p_ts = \
-      self.get_mask_idxs(batch_size, max_passage_len, passage_lens)
-    mask_q_idxs, mask_q_ts = \
-      self.get_mask_idxs(batch_size, max_question_len, question_lens)
+    # Masks of padded positions.
+    # mask_{p,q}.shape = (seq_len, batch)
+    mask_p = self.get_mask(max_passage_len, passage_lens)
+    mask_q = self.get_mask(max_question_len, question_lens)
 
     # Get embedded passage and question representations.
-    if not self.use_pretrained:
-      p = torch.transpose(self.embedding(torch.t(padded_passage)), 0, 1)
-      q = torch.transpose(self.embedding(torch.t(padded_question)), 0, 1)
-    else:
-      p = self.get_vector_embeddings(passage[0])
-      q = self.get_vector_embeddings(question[0])
+    p = self.get_embeddings(padded_passage)
+    q = self.get_embeddings(padded_question)
 
     # {p,q}.shape = (seq_len, batch, embedding_dim + num_pos_tags + num_ner_tags)
     p = torch.cat((p, self.placeholder(passage_pos_tags),
@@ -622,8 +883,7 @@ class qNet(nn.Module):
     Hr = Hp
     for layer_no in range(self.num_matchlstm_layers):
       Hr = self.match_question_passage(str(layer_no), Hr, Hq, max_passage_len,
-                                       batch_size, mask_p_idxs, mask_p_ts,
-                                       mask_q_idxs, mask_q_ts)
+                                       passage_lens, batch_size, mask_p, mask_q)
       # Question-aware passage representation dropout.
       Hr = getattr(self, 'dropout_passage_matchlstm_' + str(layer_no))(Hr)
 
@@ -636,7 +896,7 @@ class qNet(nn.Module):
     # (Question-aware) passage self-matching layers.
     for layer_no in range(self.num_selfmatch_layers):
       Hr = self.match_passage_passage(str(layer_no), Hr, max_passage_len,
-                                      batch_size, mask_p_idxs, mask_p_ts)
+                                      batch_size, mask_p)
       # Passage self-matching layer dropout.
       Hr = getattr(self, 'dropout_self_matchlstm_' + str(layer_no))(Hr)
 
@@ -660,10 +920,10 @@ class qNet(nn.Module):
     # At this point, Hr.shape = (seq_len, batch, hdim)
     answer_distributions_list, loss, mle_loss, f1_loss = \
       self.point_at_answer(Hr, Hp, Hq, batch_size, answer, f1_matrices,
-                           mask_p_idxs, mask_p_ts, mask_q_idxs, mask_q_ts)
+                           mask_p, mask_q)
 
     if self.debug_level >= 3:
-      loss.data[0]
+      scalar(loss)
       print "Answer pointer time: %.2fs" % (time.time() - start_answer)
 
     self.loss = loss
@@ -0,0 +1,159 @@
+import BaseHTTPServer
+import json
+import os
+import re
+import shutil
+import socket
+import SocketServer
+import tempfile
+import threading
+import unittest
+import urlparse
+
+from CoreNLPClient import AnnotationCache, CoreNLPClient
+
+class StubCoreNLPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  ''' Answers annotation requests like a StanfordCoreNLPServer, tokenizing
+      on whitespace. Texts containing "FAIL" get a server error, and the
+      first server.num_busy requests get a busy (503) response.'''
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, *args):
+    pass
+
+  def respond(self, status, body=""):
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_POST(self):
+    text = self.rfile.read(int(self.headers['Content-Length'])).decode('utf8')
+    with self.server.lock:
+      self.server.texts.append(text)
+      busy = self.server.num_busy > 0
+      self.server.num_busy -= 1
+    if busy:
+      return self.respond(503)
+    if "FAIL" in text:
+      return self.respond(500)
+    query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+    assert 'annotators' in json.loads(query['properties'][0])
+    tokens = [ { 'word': match.group(0),
+                 'characterOffsetBegin': match.start(),
+                 'characterOffsetEnd': match.end(),
+                 'pos': 'NN', 'ner': 'O' } \
+                 for match in re.finditer(r'\S+', text) ]
+    self.respond(200, json.dumps({ 'sentences': [ { 'tokens': tokens } ] }))
+
+class StubCoreNLPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+  def __init__(self):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubCoreNLPHandler)
+    self.lock = threading.Lock()
+    self.texts = []
+    self.num_busy = 0
+
+  def url(self):
+    return 'http://127.0.0.1:%d' % self.server_address[1]
+
+class CoreNLPClientTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = StubCoreNLPServer()
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def client(self, url=None, **kwargs):
+    return CoreNLPClient(url or self.server.url(), pool_size=2, max_tries=3,
+                         backoff_start=0.001, timeout=5, **kwargs)
+
+  def test_split_annotation_offsets(self):
+    texts = [ u"The cat  sat.", u" on the\tmat ", u"x", u"caf\xe9 au lait" ]
+    annotations = self.client(max_batch_docs=3).annotate_all(texts)
+    # Documents were batched, three to a request.
+    self.assertEqual(len(self.server.texts), 2)
+    for text, annotation in zip(texts, annotations):
+      tokens, pos_tags, ner_tags, char_offsets = annotation
+      self.assertEqual(tokens, text.split())
+      self.assertEqual(pos_tags, [ 'NN' ] * len(tokens))
+      self.assertEqual(ner_tags, [ 'O' ] * len(tokens))
+      self.assertEqual([ text[begin:end] for begin, end in char_offsets ], tokens)
+
+  def test_failed_documents_are_isolated(self):
+    client = self.client()
+    texts = [ u"a b", u"c FAIL", u"d", u"e f" ]
+    annotations = client.annotate_all(texts)
+    self.assertEqual(annotations[1], None)
+    for idx in [ 0, 2, 3 ]:
+      self.assertEqual(annotations[idx][0], texts[idx].split())
+    self.assertEqual(client.stats()['failed_docs'], 1)
+    # Server errors aren't retried.
+    self.assertEqual(client.stats()['retries'], 0)
+
+  def test_busy_server_is_retried(self):
+    self.server.num_busy = 2
+    client = self.client()
+    annotations = client.annotate_all([ u"a b", u"c" ])
+    self.assertEqual([ annotation[0] for annotation in annotations ],
+                     [ [ u"a", u"b" ], [ u"c" ] ])
+    self.assertEqual(client.stats()['retries'], 2)
+    self.assertEqual(len(self.server.texts), 3)
+
+  def test_unreachable_server_fails_batch_without_splitting(self):
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    url = 'http://127.0.0.1:%d' % sock.getsockname()[1]
+    sock.close()
+    client = self.client(url)
+    annotations = client.annotate_all([ u"a", u"b", u"c", u"d" ])
+    self.assertEqual(annotations, [ None ] * 4)
+    self.assertEqual(client.stats()['failed_docs'], 4)
+    # A single batch, tried max_tries times.
+    self.assertEqual(client.stats()['retries'], 3)
+
+class AnnotationCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'cache.db')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def stored_bytes(self, cache):
+    return cache.connection.execute(
+      "SELECT COALESCE(SUM(size), 0) FROM annotations").fetchone()[0]
+
+  def test_total_size_tracks_table(self):
+    annotation = ([ u"a" ] * 10, [ u"NN" ] * 10, [ u"O" ] * 10, [ [ 0, 1 ] ] * 10)
+    size = len(json.dumps(annotation))
+    cache = AnnotationCache(self.path, max_bytes=5 * size)
+    texts = [ u"t%d" % idx for idx in range(4) ]
+    cache.put_all('pos', texts, [ annotation ] * 4)
+    self.assertEqual(cache.total_bytes, 4 * size)
+    # Replacing entries, including one repeated within a batch, doesn't change
+    # the total size.
+    cache.put_all('pos', texts[:2] + texts[:1], [ annotation ] * 3)
+    self.assertEqual(cache.total_bytes, 4 * size)
+    self.assertEqual(cache.evictions, 0)
+    # Going over the limit evicts the least recently used entries.
+    cache.put_all('pos', [ u"t4", u"t5" ], [ annotation ] * 2)
+    self.assertEqual(cache.evictions, 2)
+    self.assertEqual(cache.total_bytes, self.stored_bytes(cache))
+    self.assertTrue(cache.total_bytes <= 0.9 * cache.max_bytes)
+    self.assertEqual(cache.get_all('pos', texts),
+                     [ annotation, annotation, None, None ])
+    # The total size is restored when the cache is reopened.
+    cache.connection.close()
+    self.assertEqual(AnnotationCache(self.path).total_bytes, 4 * size)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,119 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+import unittest
+
+from Input import create_f1_matrices
+from Main import get_batch
+from qNet import qNet, scalar
+from torch.autograd import Variable
+
+# Configuration of a small model.
+def small_config(**options):
+  config = { 'embed_size': 8, 'vocab_size': 40, 'hidden_size': 10,
+             'attention_size': 6, 'lr': 0.01, 'vectors_path': None,
+             'optimizer': 'Adamax', 'index_to_word': None,
+             'word_to_index': { '<pad>': 0 }, 'use_pretrained': False,
+             'half_embeddings': False, 'cuda': False, 'dropout': 0.0,
+             'f1_loss_multiplier': 0.5, 'f1_loss_threshold': -1.0,
+             'num_pos_tags': 3, 'num_ner_tags': 2,
+             'num_preprocessing_layers': 1, 'num_postprocessing_layers': 1,
+             'num_matchlstm_layers': 1, 'num_selfmatch_layers': 1,
+             'match_layer_type': 'recurrent', 'compile_match': False,
+             'selfmatch_window': 0, 'selfmatch_global': 4 }
+  config.update(options)
+  return config
+
+# Get a batch of random examples, on passages of different lengths.
+def random_batch(num_examples=6, seed=1234):
+  rng = np.random.RandomState(seed)
+  tokenized_paras, paras_pos_tags, paras_ner_tags = [], [], []
+  ques_to_para, question_pos_tags, question_ner_tags = {}, {}, {}
+  examples = []
+  for idx in range(num_examples):
+    para_len = rng.randint(5, 20)
+    tokenized_paras.append(rng.randint(1, 40, para_len).tolist())
+    paras_pos_tags.append(rng.randint(0, 3, para_len).tolist())
+    paras_ner_tags.append(rng.randint(0, 2, para_len).tolist())
+    qid = 'q%d' % idx
+    ques_len = rng.randint(3, 8)
+    ques_to_para[qid] = idx
+    question_pos_tags[qid] = rng.randint(0, 3, ques_len).tolist()
+    question_ner_tags[qid] = rng.randint(0, 2, ques_len).tolist()
+    start = rng.randint(0, para_len)
+    end = min(para_len - 1, start + rng.randint(0, 4))
+    examples.append([ rng.randint(1, 40, ques_len).tolist(), [ start, end ],
+                      qid, (start, end) ])
+  return get_batch(examples, ques_to_para, tokenized_paras, paras_pos_tags,
+                   paras_ner_tags, question_pos_tags, question_ner_tags, 3, 2,
+                   True)
+
+# Run a training step of a new model, returning its losses and gradients.
+def train_step(config, batch):
+  torch.manual_seed(0)
+  model = qNet(config)
+  model.set_train()
+  model(*batch)
+  model.loss.backward()
+  losses = [ scalar(model.loss), scalar(model.mle_loss), scalar(model.f1_loss) ]
+  grads = [ param.grad.data.numpy() for param in model.parameters() \
+              if param.grad is not None ]
+  return losses, grads
+
+# log(sum(exp(values))), computed without underflow.
+def log_sum_exp(values):
+  max_value = values.max()
+  return max_value + np.log(np.exp(values - max_value).sum())
+
+class qNetTest(unittest.TestCase):
+
+  @unittest.skipUnless(hasattr(torch.jit, 'script'), "TorchScript unavailable.")
+  def test_compiled_match_layers(self):
+    batch = random_batch()
+    losses, grads = train_step(small_config(), batch)
+    compiled_losses, compiled_grads = \
+      train_step(small_config(compile_match=True), batch)
+    np.testing.assert_allclose(compiled_losses, losses, rtol=1e-5)
+    self.assertEqual(len(compiled_grads), len(grads))
+    for compiled_grad, grad in zip(compiled_grads, grads):
+      np.testing.assert_allclose(compiled_grad, grad, rtol=1e-4, atol=1e-6)
+
+  def test_f1_loss_underflow(self):
+    model = qNet(small_config())
+    model.set_train()
+    batch_size, max_len = 2, 6
+    # Confident predictions at the last position, far from the answers, so
+    # that the probability mass on cells with positive F1 underflows.
+    logits = torch.zeros(batch_size, max_len)
+    logits[:, -1] = 300.0
+    logits = Variable(logits, requires_grad=True)
+    log_dist = F.log_softmax(logits, dim=1)
+    model.answer_pointer = lambda *args: ((log_dist, log_dist),
+                                          (log_dist, log_dist))
+    answers = [ (0, 1), (1, 1) ]
+    f1_matrices = create_f1_matrices(answers, [ max_len ] * batch_size, max_len)
+    # The second example has no cells with positive F1 at all.
+    f1_matrices[1] = 0.0
+    mask_p = Variable(torch.zeros(max_len, batch_size).byte())
+    _, loss, _, _ = model.point_at_answer(None, None, None, batch_size,
+                                          np.transpose(answers), f1_matrices,
+                                          mask_p, None)
+    loss.backward()
+    self.assertTrue(np.isfinite(logits.grad.data.numpy()).all())
+
+    # Expected loss, computed in double precision.
+    log_probs = log_dist.data.numpy().astype(np.float64)
+    expected = 0.0
+    for idx, (start, end) in enumerate(answers):
+      log_mle = 2 * (log_probs[idx, start] + log_probs[idx, end])
+      log_terms = [ log_mle ]
+      f1_cells = f1_matrices[idx] > 0
+      if f1_cells.any():
+        cells = log_probs[idx, :, None] + log_probs[idx, None, :]
+        log_f1 = log_sum_exp(cells[f1_cells] + np.log(f1_matrices[idx][f1_cells]))
+        log_terms.append(np.log(0.5) + 2 * log_f1)
+      expected += np.log(1.5) - log_sum_exp(np.array(log_terms))
+    self.assertAlmostEqual(scalar(loss), expected / batch_size, delta=1e-2)
+
+if __name__ == "__main__":
+  unittest.main()